@@ -0,0 +1,226 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import tempfile
+import time
+
+import torch
+
+import model
+import registry
+import save_format
+
+# 性能基准：生成不同形状和大小的合成实验，测量计算图构建、训练循环和保存/打开的耗时
+# python bench.py --out bench.json
+# python bench.py --out new.json --compare old.json  比较两个版本的结果
+# 形状：chain（单输入节点串联），wide（多个数据节点 cat 到一起），diamond（分叉再合并，共享上游节点）
+# 结果为 json，每条记录由 shape, size, metric, batch_size 识别，耗时取 repeat 次中的最小值
+
+SHAPES = ['chain', 'wide', 'diamond']
+
+
+def random_column(rows, seed=0):
+    # 合成的数据节点
+    generator = torch.Generator().manual_seed(seed)
+    return torch.randn(rows, 1, generator=generator)
+
+
+def mix(in_items):
+    # 合成的预处理节点，输出与输入形状相同
+    return sum(in_items) / len(in_items)
+
+
+registry.register('bench.random_column')
+registry.register('bench.mix')
+
+
+def build_graph(shape, size, rows, layers=4, hidden=32, epoch=2, batch_size=32, model_path=''):
+    # 返回嵌套形式的计算图（队尾节点列表）和网络的输入节点
+    nodes = []
+
+    def node(dtype, kwargs, in_items=()):
+        model_ = {'id': len(nodes), 'name': f'{dtype}{len(nodes)}', 'dtype': dtype, 'pos': [0, 0],
+                  'kwargs': kwargs, 'in_items': list(in_items)}
+        nodes.append(model_)
+        return model_
+
+    def data():
+        return node('data', {'func': 'bench.random_column', 'rows': rows, 'seed': len(nodes)})
+
+    def preprocess(in_items):
+        return node('preprocess', {'func': 'bench.mix'}, in_items)
+
+    if shape == 'chain':
+        x = data()
+        for _ in range(size):
+            x = preprocess([x])
+        features = 1
+    elif shape == 'wide':
+        x = node('preprocess', {'func': 'cat', 'tensors': [], 'dim': 1}, [data() for _ in range(size)])
+        features = size
+    elif shape == 'diamond':
+        x = data()
+        for _ in range(size):
+            x = preprocess([preprocess([x]), preprocess([x])])
+        features = 1
+    else:
+        raise Exception('Unknown shape: ' + shape)
+
+    net = x
+    in_features = features
+    for _ in range(layers - 1):
+        net = node('model', {'func': 'torch.nn.Linear', 'in_features': in_features, 'out_features': hidden}, [net])
+        net = node('model', {'func': 'torch.nn.ReLU'}, [net])
+        in_features = hidden
+    net = node('model', {'func': 'torch.nn.Linear', 'in_features': in_features, 'out_features': 1}, [net])
+
+    loss = node('loss', {'func': 'torch.nn.MSELoss'}, [net, data()])
+    optimizer = node('optimizer', {'func': 'torch.optim.SGD', 'params': [], 'lr': 0.01}, [loss])
+    hyperparameters = node('hyperparameters', {
+        'func': 'DL', 'epoch': epoch, 'batch_size': batch_size, 'shuffle': True, 'gpu': False, 'seed': 0,
+        'epoch_loss': True, 'accuracy': False, 'epoch_time': True, 'model_path': model_path,
+    })
+    return [optimizer, hyperparameters], x
+
+
+def best_of(repeat, f):
+    times = []
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - tic)
+    return min(times)
+
+
+def bench_graph(shape, size, rows, layers, batch_sizes, epochs, repeat, directory):
+    models, x = build_graph(shape, size, rows, layers)
+    loss_model = models[0]['in_items'][0]
+    net_model = loss_model['in_items'][0]
+    nodes, edges = save_format.flatten(models)
+    results = []
+
+    def record(metric, seconds, **kwargs):
+        results.append(dict({'shape': shape, 'size': size, 'nodes': len(nodes), 'edges': len(edges),
+                             'metric': metric, 'seconds': seconds}, **kwargs))
+
+    record('build_data', best_of(repeat, lambda: model.build_data(x)))
+
+    # 网络的输入预先放入缓存，只测量层的构建
+    x_value = model.build_data(x)
+
+    def build_net():
+        cache = model.NodeCache([net_model])
+        cache.values[model.node_key(x)] = x_value
+        model.build_net(net_model, cache)
+
+    record('build_net', best_of(repeat, build_net))
+
+    # 保存/打开：与编辑器相同的 0.2.0 json
+    path = os.path.join(directory, f'{shape}_{size}.json')
+
+    def save():
+        nodes_, edges_ = save_format.flatten(models)
+        js = {'save_version': save_format.SAVE_VERSION, 'module_version': '0.1.0',
+              'scene': {'item_count': len(nodes_)}, 'nodes': nodes_, 'edges': edges_}
+        with open(path, 'w') as f:
+            json.dump(js, f)
+
+    record('save', best_of(repeat, save), bytes=os.path.getsize(path))
+    record('open', best_of(repeat, lambda: save_format.nest(save_format.load(path))))
+
+    # 训练循环：每个 batch size 单独运行，取各 epoch 中最快的一次
+    for batch_size in batch_sizes:
+        metrics_path = os.path.join(directory, f'{shape}_{size}_{batch_size}.jsonl')
+        models_, _ = build_graph(shape, size, rows, layers, epoch=epochs, batch_size=batch_size,
+                                 model_path=os.path.join(directory, 'model.pt'))
+        models_[1]['kwargs']['metrics_path'] = metrics_path
+        with contextlib.redirect_stdout(io.StringIO()):
+            model.DL(models_)
+        with open(metrics_path) as f:
+            epochs_ = [json.loads(line) for line in f]
+        epoch_ = min(epochs_, key=lambda e: e['epoch_time'])
+        record('dl_epoch', epoch_['epoch_time'], batch_size=batch_size, rows=rows,
+               samples_per_second=epoch_['samples_per_second'])
+
+    return results
+
+
+def benchmark(shapes=SHAPES, sizes=(8, 64, 512), rows=10000, layers=4, batch_sizes=(32, 256, 2048), epochs=2,
+              repeat=5):
+    with tempfile.TemporaryDirectory() as directory:
+        results = []
+        for shape in shapes:
+            for size in sizes:
+                results += bench_graph(shape, size, rows, layers, batch_sizes, epochs, repeat, directory)
+
+    return {
+        'environment': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'threads': torch.get_num_threads(),
+        },
+        'config': {'shapes': list(shapes), 'sizes': list(sizes), 'rows': rows, 'layers': layers,
+                   'batch_sizes': list(batch_sizes), 'epochs': epochs, 'repeat': repeat},
+        'results': results,
+    }
+
+
+def result_key(result):
+    return result['shape'], result['size'], result['metric'], result.get('batch_size')
+
+
+def compare(old, new):
+    # 新旧结果按记录匹配，ratio > 1 表示变慢
+    old_results = {result_key(result): result for result in old['results']}
+    rows = []
+    for result in new['results']:
+        key = result_key(result)
+        if key in old_results:
+            rows.append(dict(zip(['shape', 'size', 'metric', 'batch_size'], key),
+                             old=old_results[key]['seconds'], new=result['seconds'],
+                             ratio=result['seconds'] / old_results[key]['seconds']))
+    return rows
+
+
+def print_results(results):
+    print(f"{'shape':<10}{'size':>6}{'nodes':>7} {'metric':<11}{'batch':>7}{'ms':>12}")
+    for result in results:
+        print(f"{result['shape']:<10}{result['size']:>6}{result['nodes']:>7} {result['metric']:<11}"
+              f"{result.get('batch_size') or '':>7}{result['seconds'] * 1e3:>12.3f}")
+
+
+def print_compare(rows):
+    print(f"{'shape':<10}{'size':>6} {'metric':<11}{'batch':>7}{'old ms':>12}{'new ms':>12}{'ratio':>8}")
+    for row in rows:
+        print(f"{row['shape']:<10}{row['size']:>6} {row['metric']:<11}{row['batch_size'] or '':>7}"
+              f"{row['old'] * 1e3:>12.3f}{row['new'] * 1e3:>12.3f}{row['ratio']:>8.2f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark graph construction, training loop and save/open.')
+    parser.add_argument('--out', default='bench.json', help='json file for the results')
+    parser.add_argument('--compare', help='results of a previous version to compare with')
+    parser.add_argument('--shapes', nargs='+', default=SHAPES, choices=SHAPES)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[8, 64, 512])
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--layers', type=int, default=4)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[32, 256, 2048])
+    parser.add_argument('--epochs', type=int, default=2)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    results = benchmark(args.shapes, args.sizes, args.rows, args.layers, args.batch_sizes, args.epochs, args.repeat)
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=4)
+    print_results(results['results'])
+    print('Results saved in', args.out)
+
+    if args.compare:
+        with open(args.compare) as f:
+            print_compare(compare(json.load(f), results))
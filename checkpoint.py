@@ -0,0 +1,131 @@
+import os
+import queue
+import re
+import threading
+
+import torch
+
+# 训练中定期保存检查点：模型、优化器、随机数状态和 epoch
+# 训练线程只复制一份状态（snapshot），由后台线程写入磁盘，训练不等待磁盘
+# 文件写入临时文件后再改名，崩溃时不会留下写了一半的检查点
+# 目录为 <model_path>.checkpoints，文件名为 epoch-<epoch>.pt，只保留最新的 keep_last 个
+
+PATTERN = re.compile(r'^epoch-(\d+)\.pt$')
+
+
+def directory(model_path):
+    return model_path + '.checkpoints'
+
+
+def snapshot(state):
+    # 把嵌套的 state_dict 中的 tensor 复制到 cpu，之后训练继续修改参数不影响这份状态
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {k: snapshot(v) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(v) for v in state)
+    return state
+
+
+def rng_state():
+    state = {'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def checkpoints(path):
+    # 按 epoch 从新到旧排列的检查点文件
+    if not os.path.isdir(path):
+        return []
+    found = []
+    for file_name in os.listdir(path):
+        match = PATTERN.match(file_name)
+        if match:
+            found.append((int(match.group(1)), os.path.join(path, file_name)))
+    return [file_path for _, file_path in sorted(found, reverse=True)]
+
+
+def load_latest(path):
+    # 返回最新的可以完整读取的检查点，损坏的文件跳过；没有时返回 None
+    for file_path in checkpoints(path):
+        try:
+            state = torch.load(file_path, map_location='cpu')
+        except Exception as e:
+            print('Skip invalid checkpoint', file_path, type(e).__name__)
+            continue
+        if all(k in state for k in ('epoch', 'model', 'optimizer', 'rng')):
+            return state
+        print('Skip invalid checkpoint', file_path)
+    return None
+
+
+def resume(path, net, optimizer):
+    # 从最新的有效检查点继续，随机数状态一起恢复，shuffle 的顺序与不中断时相同
+    # 返回开始的 epoch，没有检查点时为 0
+    state = load_latest(path)
+    if state is None:
+        return 0
+    net.load_state_dict(state['model'])
+    optimizer.load_state_dict(state['optimizer'])
+    set_rng_state(state['rng'])
+    print('Resume from epoch', state['epoch'])
+    return state['epoch'] + 1
+
+
+class Checkpointer:
+    def __init__(self, path, keep_last=3):
+        # keep_last <= 0 表示保留所有检查点
+        self.path = path
+        self.keep_last = keep_last
+        self.queue = queue.Queue(maxsize=1)  # 上一个检查点还没写完时最多再排队一个
+        self.error = None
+        self.written = 0
+        os.makedirs(path, exist_ok=True)
+        self.thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.thread.start()
+
+    def save(self, epoch, net, optimizer, **extra):
+        # 在训练线程中调用，复制状态后立即返回
+        if self.error is not None:
+            raise self.error
+        if isinstance(net, torch.nn.parallel.DistributedDataParallel):
+            net = net.module
+        state = {
+            'epoch': epoch,
+            'model': snapshot(net.state_dict()),
+            'optimizer': snapshot(optimizer.state_dict()),
+            'rng': rng_state(),
+        }
+        state.update(extra)
+        self.queue.put(state)
+
+    def _write_loop(self):
+        while True:
+            state = self.queue.get()
+            if state is None:
+                return
+            try:
+                file_path = os.path.join(self.path, 'epoch-{:06d}.pt'.format(state['epoch']))
+                torch.save(state, file_path + '.tmp')
+                os.replace(file_path + '.tmp', file_path)
+                self.written += 1
+                if self.keep_last > 0:
+                    for old in checkpoints(self.path)[self.keep_last:]:
+                        os.remove(old)
+            except Exception as e:
+                self.error = e
+
+    def close(self):
+        # 等待已经排队的检查点写完
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
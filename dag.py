@@ -0,0 +1,124 @@
+import concurrent.futures
+import os
+import re
+
+import torch
+
+import graph
+
+# 网络部分的计算图编译为一个 module，按拓扑顺序执行
+# 网络部分为 model 节点，以及输入中有网络输出的 preprocess 节点（如合并多个分支的 cat）
+# 不依赖网络输出的节点是网络的输入，由 build_data 构建
+# 多个输入时数据在 dim=1 上拼接后送入网络，forward 中再按列切开（视图，不复制），
+# 这样 TensorBatches / MappedDataset / 流式数据都不需要修改；也可以直接调用 net(x1, x2, ...)
+# concurrent=True 时同一层中互不依赖的分支在线程池中同时执行前向（torch 的计算会释放 GIL），
+# 分支较小时线程调度的开销大于收益，默认关闭
+
+_executor = None
+
+
+def executor():
+    global _executor
+    if _executor is None:
+        _executor = concurrent.futures.ThreadPoolExecutor(os.cpu_count() or 1)
+    return _executor
+
+
+class GraphModule(torch.nn.Module):
+    # steps: (name, module 或 None, func, kwargs, 输入下标) 列表，按拓扑顺序排列
+    # 下标 0..inputs-1 为网络的输入，之后依次为各步的输出，最后一步为网络的输出
+    def __init__(self, inputs, steps, widths=None, concurrent=False):
+        super().__init__()
+        self.inputs = inputs
+        self.widths = widths  # 拼接输入的各列宽度，None 表示分开传入
+        self.concurrent = concurrent
+        self.steps = []
+        for name, module, func, kwargs, refs in steps:
+            if module is not None:
+                self.add_module(name, module)
+            self.steps.append((module, func, kwargs, refs))
+
+        # 每个中间结果在最后一次使用后释放
+        last_use = {}
+        for i, (_, _, _, refs) in enumerate(self.steps):
+            for ref in refs:
+                last_use[ref] = i
+        self.release = [[ref for ref, i_ in last_use.items() if i_ == i] for i in range(len(self.steps))]
+
+        # 按依赖深度分层，同一层的步骤互不依赖
+        depth = [0] * inputs
+        self.levels = []
+        for i, (_, _, _, refs) in enumerate(self.steps):
+            level = max(depth[ref] for ref in refs) if refs else 0
+            depth.append(level + 1)
+            if level == len(self.levels):
+                self.levels.append([])
+            self.levels[level].append(i)
+
+    def run(self, i, values):
+        module, func, kwargs, refs = self.steps[i]
+        args = [values[ref] for ref in refs]
+        if module is not None:
+            return module(*args)
+        return func(in_items=args, **kwargs)
+
+    def forward(self, *xs):
+        if self.widths is not None and len(xs) == 1:
+            xs = torch.split(xs[0], self.widths, dim=1)
+        if len(xs) != self.inputs:
+            raise Exception(f'Net needs {self.inputs} inputs, got {len(xs)}.')
+
+        values = dict(enumerate(xs))
+        if not self.concurrent:
+            for i in range(len(self.steps)):
+                values[self.inputs + i] = self.run(i, values)
+                for ref in self.release[i]:
+                    del values[ref]
+        else:
+            for level in self.levels:
+                if len(level) == 1:
+                    results = [self.run(level[0], values)]
+                else:
+                    futures = [executor().submit(self.run, i, values) for i in level]
+                    results = [future.result() for future in futures]
+                for i, result in zip(level, results):
+                    values[self.inputs + i] = result
+                for i in level:
+                    for ref in self.release[i]:
+                        values.pop(ref, None)
+        return values[self.inputs + len(self.steps) - 1]
+
+
+def module_name(index, name):
+    # state_dict 的键：步骤下标加节点名字
+    return f'{index}_' + re.sub(r'\W', '_', name)
+
+
+def collect(output, in_net, key):
+    # output: 网络的输出节点；in_net(node): 是否属于网络；key(node): 节点的唯一标识
+    # 返回 (inputs, order)：网络的输入节点，以及网络中的节点按拓扑顺序的列表
+    nodes = graph.upstream_order([output], key, in_net)
+    inputs = [node for node in nodes if not in_net(node)]
+    order = [node for node in nodes if in_net(node)]
+    return inputs, order
+
+
+def compile_net(output, in_net, build_layer, resolve, key):
+    # build_layer(node): 构建 model 节点的 module；resolve(func): preprocess 节点的函数
+    # 返回 (inputs, steps)，见 GraphModule
+    inputs, order = collect(output, in_net, key)
+
+    # 下标：输入在前，各步的输出在后
+    index = {key(node): i for i, node in enumerate(inputs)}
+    index.update({key(node): len(inputs) + i for i, node in enumerate(order)})
+
+    steps = []
+    for i, node in enumerate(order):
+        refs = [index[key(in_item)] for in_item in node['in_items']]
+        if node['dtype'] == 'model':
+            steps.append((module_name(i, node['name']), build_layer(node), None, None, refs))
+        else:
+            kwargs = dict(node['kwargs'])
+            func = resolve(kwargs.pop('func'))
+            steps.append((module_name(i, node['name']), None, func, kwargs, refs))
+    return inputs, steps
@@ -1,13 +1,94 @@
+import threading
+from collections import OrderedDict
 from functools import wraps
 
+import numpy as np
 import torch
-from sklearn.datasets import load_boston
+
+import stream
+import tensor_store
+
+
+class ColumnCache:
+    # 进程内共享的列式数据缓存
+    # 每个数据源只加载一次，按列保存为连续的 float32 tensor，getter 返回零拷贝的视图
+    # 返回的 tensor 是只读的：所有 getter 和之后的运行共用同一块内存，下游节点不能原地修改（add_、x[i] = ...），
+    # 需要修改时先 clone()。视图与缓存共用 torch 的版本计数，原地修改会被发现，下次访问时丢弃该数据源并重新加载
+    # 超过 max_bytes 时按 LRU 淘汰整个数据源
+    def __init__(self, max_bytes=1 << 30):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._loaders = {}  # source -> loader
+        self._tables = OrderedDict()  # source -> {column: torch.Tensor}
+        self._lock = threading.RLock()
+
+    def register(self, source, loader):
+        # loader() 返回 {column: 1维数组}
+        with self._lock:
+            self._loaders[source] = loader
+            self._evict(source)
+
+    def table(self, source):
+        with self._lock:
+            if source in self._tables:
+                if any(v._version for v in self._tables[source].values()):
+                    print(f'Warning! Cached data {source} was modified in place, reloading.')
+                    self._evict(source)
+                else:
+                    self.hits += 1
+                    self._tables.move_to_end(source)
+                    return self._tables[source]
+
+            self.misses += 1
+            columns = self._loaders[source]()
+            table = {k: torch.from_numpy(np.ascontiguousarray(v, dtype=np.float32)) for k, v in columns.items()}
+            self._tables[source] = table
+            self.nbytes += sum(v.nbytes for v in table.values())
+
+            # 淘汰最久未使用的数据源，但保留刚加载的
+            while self.nbytes > self.max_bytes and len(self._tables) > 1:
+                self._evict(next(iter(self._tables)))
+
+            return table
+
+    def column(self, source, column):
+        return self.table(source)[column]
+
+    def _evict(self, source):
+        table = self._tables.pop(source, None)
+        if table is not None:
+            self.nbytes -= sum(v.nbytes for v in table.values())
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            for source in list(self._tables):
+                self._evict(source)
+
+    def info(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'sources': list(self._tables),
+                'nbytes': self.nbytes,
+                'max_bytes': self.max_bytes,
+            }
+
+
+cache = ColumnCache()
 
 
 def tensor_wrapper(func):
     @wraps(func)
     def f(*args, **kwargs):
-        tensor = torch.Tensor(func(*args, **kwargs))
+        # as_tensor 对 float32 数据不拷贝，与缓存共享内存，返回的 tensor 只读，见 ColumnCache
+        tensor = torch.as_tensor(func(*args, **kwargs), dtype=torch.float32)
         if tensor.dim() == 1:
             # tensor为向量则添加一维 > N * 1
             tensor = tensor.unsqueeze(-1)
@@ -15,71 +96,144 @@ def tensor_wrapper(func):
     return f
 
 
+def declare_schema(schema):
+    # schema(**kwargs) 返回 (shape, dtype)，行数未知时 shape[0] 为 None
+    # 只读取元数据，不加载数据，用于 validate 的形状检查
+    def decorator(func):
+        func.schema = schema
+        return func
+    return decorator
+
+
+def boston_schema():
+    return (BOSTON_ROWS, 1), torch.float32
+
+
+def store_column_schema(path, column):
+    store = tensor_store.TensorStore(path, create=False)
+    if column not in store.columns:
+        raise Exception(f'No column {column} in {path}.')
+    return (store.rows(column), 1), torch.float32
+
+
+def stream_schema(*args, **kwargs):
+    return (None, 1), torch.float32
+
+
+BOSTON_ROWS = 506
+BOSTON_COLUMNS = ['CRIM', 'ZN', 'INDUS', 'CHAS', 'NOX', 'RM', 'AGE', 'DIS', 'RAD', 'TAX', 'PTRATIO', 'B', 'LSTAT']
+
+
+def load_boston_columns():
+    from sklearn.datasets import load_boston
+
+    boston = load_boston()
+    columns = {name: boston['data'][:, i] for i, name in enumerate(BOSTON_COLUMNS)}
+    columns['PRICE'] = boston['target']
+    return columns
+
+
+cache.register('boston', load_boston_columns)
+
+
+@declare_schema(boston_schema)
 @tensor_wrapper
 def get_boston_CRIM():
-    return torch.Tensor(load_boston()['data'][:, 0])
+    return cache.column('boston', 'CRIM')
 
 
+@declare_schema(boston_schema)
 @tensor_wrapper
 def get_boston_ZN():
-    return load_boston()['data'][:, 1]
+    return cache.column('boston', 'ZN')
 
 
+@declare_schema(boston_schema)
 @tensor_wrapper
 def get_boston_INDUS():
-    return load_boston()['data'][:, 2]
+    return cache.column('boston', 'INDUS')
 
 
+@declare_schema(boston_schema)
 @tensor_wrapper
 def get_boston_CHAS():
-    return load_boston()['data'][:, 3]
+    return cache.column('boston', 'CHAS')
 
 
+@declare_schema(boston_schema)
 @tensor_wrapper
 def get_boston_NOX():
-    return load_boston()['data'][:, 4]
+    return cache.column('boston', 'NOX')
 
 
+@declare_schema(boston_schema)
 @tensor_wrapper
 def get_boston_RM():
-    return load_boston()['data'][:, 5]
+    return cache.column('boston', 'RM')
 
 
+@declare_schema(boston_schema)
 @tensor_wrapper
 def get_boston_AGE():
-    return load_boston()['data'][:, 6]
+    return cache.column('boston', 'AGE')
 
 
+@declare_schema(boston_schema)
 @tensor_wrapper
 def get_boston_DIS():
-    return load_boston()['data'][:, 7]
+    return cache.column('boston', 'DIS')
 
 
+@declare_schema(boston_schema)
 @tensor_wrapper
 def get_boston_RAD():
-    return load_boston()['data'][:, 8]
+    return cache.column('boston', 'RAD')
 
 
+@declare_schema(boston_schema)
 @tensor_wrapper
 def get_boston_TAX():
-    return load_boston()['data'][:, 9]
+    return cache.column('boston', 'TAX')
 
 
+@declare_schema(boston_schema)
 @tensor_wrapper
 def get_boston_PTRATIO():
-    return load_boston()['data'][:, 10]
+    return cache.column('boston', 'PTRATIO')
 
 
+@declare_schema(boston_schema)
 @tensor_wrapper
 def get_boston_B():
-    return load_boston()['data'][:, 11]
+    return cache.column('boston', 'B')
 
 
+@declare_schema(boston_schema)
 @tensor_wrapper
 def get_boston_LSTAT():
-    return load_boston()['data'][:, 12]
+    return cache.column('boston', 'LSTAT')
 
 
+@declare_schema(boston_schema)
 @tensor_wrapper
 def get_boston_PRICE():
-    return load_boston()['target']
+    return cache.column('boston', 'PRICE')
+
+
+@declare_schema(store_column_schema)
+def get_store_column(path, column):
+    # 内存映射的列式 store，返回零拷贝的 N * 1 tensor
+    # 非 float32 的列（如归档的 float64）也保持映射，训练时按 batch 转换为 float32，见 tensor_store.read_rows
+    return tensor_store.TensorStore(path, create=False).tensor(column)
+
+
+@declare_schema(stream_schema)
+def stream_store_column(path, column, chunk_rows=65536):
+    # 流式读取归档数据，用于 DL 的流式训练
+    return stream.store_column(path, column, chunk_rows)
+
+
+@declare_schema(stream_schema)
+def stream_pv(pvname, period=0.1, chunk_rows=64):
+    # 实时 PV 数据流，用于 DL 的流式训练
+    return stream.pv(pvname, period, chunk_rows)
@@ -1,21 +1,370 @@
-import epics
 import csv
+import io
+import json
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+
+import pv_backend
+import tensor_store
+
+
+class RingBuffer:
+    # 预分配的单生产者单消费者环形缓冲区
+    # 生产者（monitor 回调线程）只写入未被占用的槽位，满了就丢弃新样本，不会阻塞
+    # 消费者（写线程）在锁外拷贝已占用的槽位，锁只保护下标
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.timestamps = np.empty(capacity, dtype=np.float64)
+        self.values = np.empty(capacity, dtype=np.float64)
+        self.head = 0
+        self.count = 0
+        self.received = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def push(self, timestamp, value) -> bool:
+        with self._lock:
+            self.received += 1
+            if self.count == self.capacity:
+                self.dropped += 1
+                return False
+            tail = (self.head + self.count) % self.capacity
+            self.timestamps[tail] = timestamp
+            self.values[tail] = value
+            self.count += 1
+        return True
+
+    def drain(self):
+        with self._lock:
+            head, n = self.head, self.count
+        index = (np.arange(n) + head) % self.capacity
+        timestamps, values = self.timestamps[index], self.values[index]
+        with self._lock:
+            self.head = (head + n) % self.capacity
+            self.count -= n
+        return timestamps, values
+
+
+class ChangeArchiver:
+    # 订阅 PV monitor，回调只把样本放进每个 PV 的环形缓冲区
+    # 后台写线程批量追加到列式 store：每个 PV 一个记录表 '<pv>'，字段为 time 和 value
+    # 每条记录的时间和值在同一个文件中一次写入，读取时仍是 '<pv>.time' 和 '<pv>.value' 两列，
+    # 写入中途崩溃也不会让两列的行数不同
+    # backend: 提供 PV(pvname, callback=..., auto_monitor=True) 的模块或对象，见 pv_backend.get
+    def __init__(self, pvnames, path, capacity=65536, flush_interval=1.0, backend=None):
+        self.pvnames = list(pvnames)
+        self.store = tensor_store.TensorStore(path)
+        self.flush_interval = flush_interval
+        self.backend = pv_backend.get(backend)
+        self.buffers = {pvname: RingBuffer(capacity) for pvname in self.pvnames}
+
+        self.pvs = []
+        self.written = 0
+        self.bytes_written = 0
+        self.write_time = 0.0
+        self.start_time = None
+        self._flush_event = threading.Event()
+        self._stop_event = threading.Event()
+        self._writer = None
+
+        self.dtypes = {}
+        for pvname in self.pvnames:
+            column = self.store.manifest['columns'].get(pvname + '.time')
+            if column is not None and 'table' not in column:
+                raise Exception(f'{path} has separate time and value columns for {pvname}, use a new store.')
+            self.dtypes[pvname] = self.store.add_table(pvname, [('time', 'float64'), ('value', 'float64')])
+
+    def _on_change(self, pvname=None, value=None, timestamp=None, **kwargs):
+        buffer = self.buffers[pvname]
+        buffer.push(timestamp if timestamp is not None else time.time(), value)
+        if buffer.count >= buffer.capacity // 2:
+            # 缓冲区过半，提前唤醒写线程
+            self._flush_event.set()
+
+    def start(self):
+        self.start_time = time.time()
+        self._stop_event.clear()
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+        self.pvs = [self.backend.PV(pvname, callback=self._on_change, auto_monitor=True) for pvname in self.pvnames]
+        return self
+
+    def stop(self):
+        for pv in self.pvs:
+            pv.clear_callbacks()
+            pv.disconnect()
+        self.pvs = []
+
+        self._stop_event.set()
+        self._flush_event.set()
+        if self._writer is not None:
+            self._writer.join()
+            self._writer = None
+        return self.stats()
+
+    def _write_loop(self):
+        while not self._stop_event.is_set():
+            self._flush_event.wait(self.flush_interval)
+            self._flush_event.clear()
+            self.flush()
+        self.flush()
+
+    def flush(self):
+        tic = time.time()
+        for pvname, buffer in self.buffers.items():
+            timestamps, values = buffer.drain()
+            if len(values) == 0:
+                continue
+            records = np.empty(len(values), dtype=self.dtypes[pvname])
+            records['time'] = timestamps
+            records['value'] = values
+            self.store.append_records(pvname, records)
+            self.written += len(values)
+            self.bytes_written += records.nbytes
+        self.write_time += time.time() - tic
+
+    def stats(self):
+        elapsed = time.time() - self.start_time if self.start_time else 0.0
+        return {
+            'received': sum(buffer.received for buffer in self.buffers.values()),
+            'queued': sum(buffer.count for buffer in self.buffers.values()),
+            'dropped': sum(buffer.dropped for buffer in self.buffers.values()),
+            'written': self.written,
+            'bytes_written': self.bytes_written,
+            'elapsed': elapsed,
+            'write_time': self.write_time,
+            'samples_per_second': self.written / elapsed if elapsed else 0.0,
+            'write_bytes_per_second': self.bytes_written / self.write_time if self.write_time else 0.0,
+        }
+
+
+class TimeSampler:
+    # 以固定周期采样一组 PV，每个周期只做一次批量读取（caget_many）
+    # 第 k 次采样的截止时间为 start + k * period，不会累积漂移；错过的周期直接跳过并计数
+    # 每个周期写一条定长记录：time + 每个 PV 一个 float64，存为 tensor store 中的记录表
+    # backend: 提供 caget_many(pvnames, timeout=...) 的模块或对象，见 pv_backend.get
+    def __init__(self, pvnames, path, period, table='sample', flush_records=1024, backend=None):
+        self.pvnames = list(pvnames)
+        self.period = period
+        self.table = table
+        self.backend = pv_backend.get(backend)
+        self.store = tensor_store.TensorStore(path)
+        fields = [['time', 'float64']] + [[pvname, 'float64'] for pvname in self.pvnames]
+        existing = self.store.manifest.get('tables', {}).get(table)
+        if existing is not None and existing['fields'] != fields:
+            # add_table 不会修改已有的表，PV 列表不同时记录会错位或写到旧的列名下
+            raise Exception(f'Table {table} in {path} was recorded with different PVs, use a new table or store.')
+        dtype = self.store.add_table(table, fields)
+        self.records = np.empty(flush_records, dtype=dtype)
+        self.n_records = 0
+
+        self.ticks = 0
+        self.missed = 0
+        self.overruns = 0  # 批量读取耗时超过一个周期
+        self.lateness_sum = 0.0
+        self.lateness_sq_sum = 0.0
+        self.lateness_max = 0.0
+        self.read_time_sum = 0.0
+        self.read_time_max = 0.0
+
+    def run(self, duration):
+        start = time.monotonic()
+        end = start + duration
+        k = 0
+        try:
+            while True:
+                deadline = start + k * self.period
+                if deadline >= end:
+                    break
+                now = time.monotonic()
+                if now < deadline:
+                    time.sleep(deadline - now)
+                    now = time.monotonic()
+
+                lateness = now - deadline
+                if lateness >= self.period:
+                    # 已经错过后面的周期，跳到最近的一个
+                    skipped = int(lateness // self.period)
+                    self.missed += skipped
+                    k += skipped
+                    lateness -= skipped * self.period
+                self.tick(lateness)
+                k += 1
+        finally:
+            self.flush()
+        return self.stats()
+
+    def tick(self, lateness):
+        tic = time.monotonic()
+        timestamp = time.time()
+        values = self.backend.caget_many(self.pvnames, timeout=self.period)
+        read_time = time.monotonic() - tic
+
+        self.records[self.n_records] = (timestamp, *(np.nan if value is None else value for value in values))
+        self.n_records += 1
+        if self.n_records == len(self.records):
+            self.flush()
+
+        self.ticks += 1
+        self.lateness_sum += lateness
+        self.lateness_sq_sum += lateness * lateness
+        self.lateness_max = max(self.lateness_max, lateness)
+        self.read_time_sum += read_time
+        self.read_time_max = max(self.read_time_max, read_time)
+        if read_time > self.period:
+            self.overruns += 1
+
+    def flush(self):
+        if self.n_records:
+            self.store.append_records(self.table, self.records[:self.n_records])
+            self.n_records = 0
+
+    def stats(self):
+        n = max(self.ticks, 1)
+        mean = self.lateness_sum / n
+        return {
+            'ticks': self.ticks,
+            'missed': self.missed,
+            'overruns': self.overruns,
+            'jitter_mean': mean,
+            'jitter_std': max(self.lateness_sq_sum / n - mean * mean, 0.0) ** 0.5,
+            'jitter_max': self.lateness_max,
+            'read_time_mean': self.read_time_sum / n,
+            'read_time_max': self.read_time_max,
+        }
+
+
+class ConnectionPool:
+    # 跨多次快照复用的 PV 连接和读取线程池，第一次之后不需要重新建立连接
+    # backend: 提供 PV(pvname, auto_monitor=False) 的模块或对象，见 pv_backend.get
+    def __init__(self, backend=None, workers=32, connection_timeout=1.0):
+        self._backend = backend
+        self.workers = workers
+        self.connection_timeout = connection_timeout
+        self.pvs = {}
+        self._executor = None
+
+    @property
+    def backend(self):
+        # 模块级的 pool 在导入时创建，backend 到第一次使用时才确定
+        return pv_backend.get(self._backend)
+
+    def connect(self, pvnames):
+        # PV 对象创建后在后台并行连接，依次等待的总时间约等于最慢的一个
+        new = []
+        for pvname in pvnames:
+            if pvname not in self.pvs:
+                self.pvs[pvname] = self.backend.PV(pvname, auto_monitor=False)
+                new.append(self.pvs[pvname])
+        for pv in new:
+            pv.wait_for_connection(timeout=self.connection_timeout)
+        return [self.pvs[pvname] for pvname in pvnames]
+
+    def _init_thread(self):
+        # pyepics 的工作线程需要加入主线程的 CA context
+        ca = getattr(self.backend, 'ca', None)
+        if ca is not None:
+            ca.use_initial_context()
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.workers, initializer=self._init_thread)
+        return self._executor
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        for pv in self.pvs.values():
+            pv.disconnect()
+        self.pvs = {}
+
+
+pool = ConnectionPool()
+
+
+def read_pv(pv, timeout):
+    if not pv.connected:
+        return pv.pvname, None, None, 'disconnected'
+    value = pv.get(timeout=timeout, use_monitor=False)
+    if value is None:
+        return pv.pvname, None, None, 'timeout'
+    return pv.pvname, value, pv.timestamp, 'ok'
+
+
+def format_value(value):
+    # 波形等数组写成 json 列表，保留所有元素和完整精度（numpy 的 str 会把长数组省略为 ...）
+    if isinstance(value, np.ndarray):
+        return json.dumps(value.tolist())
+    if isinstance(value, (list, tuple)):
+        return json.dumps([item.item() if isinstance(item, np.generic) else item for item in value])
+    return value
+
 
 def save():
     pass
 
-def save_by_time():
-    pass
+def save_by_time(pvnames, path, period, duration, **kwargs):
+    # 每 period 秒采样一次 pvnames，持续 duration 秒，返回采样统计
+    return TimeSampler(pvnames, path, period, **kwargs).run(duration)
 
-def save_by_change():
-    pass
+def save_by_change(pvnames, path, duration, **kwargs):
+    # 记录 pvnames 在 duration 秒内的所有变化，返回统计信息
+    archiver = ChangeArchiver(pvnames, path, **kwargs).start()
+    try:
+        time.sleep(duration)
+    finally:
+        stats = archiver.stop()
+    return stats
 
-def save_all():
-    pass
+def save_all(pvnames, path, timeout=1.0, chunk=1024, connection_pool=None):
+    # 并发读取 pvnames 的当前值，按完成顺序流式写入一个 csv 快照；波形等数组值写为 json 列表
+    # 返回各阶段耗时：connect, read（等待读取结果）, serialize, write
+    connection_pool = connection_pool or pool
+    timing = {'connect': 0.0, 'read': 0.0, 'serialize': 0.0, 'write': 0.0}
+
+    tic = time.perf_counter()
+    pvs = connection_pool.connect(pvnames)
+    timing['connect'] = time.perf_counter() - tic
+
+    futures = [connection_pool.executor.submit(read_pv, pv, timeout) for pv in pvs]
+    with open(path, 'w', newline='') as f:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(['pvname', 'value', 'timestamp', 'status'])
+        rows = 0
+
+        tic = time.perf_counter()
+        for future in as_completed(futures):
+            pvname, value, timestamp, status = future.result()
+            toc = time.perf_counter()
+            timing['read'] += toc - tic
+
+            writer.writerow([pvname, format_value(value), timestamp, status])
+            rows += 1
+            tic = time.perf_counter()
+            timing['serialize'] += tic - toc
+
+            if rows % chunk == 0:
+                f.write(buffer.getvalue())
+                buffer.seek(0)
+                buffer.truncate()
+                toc = time.perf_counter()
+                timing['write'] += toc - tic
+                tic = toc
+
+        tic = time.perf_counter()
+        f.write(buffer.getvalue())
+    timing['write'] += time.perf_counter() - tic
+    timing['total'] = sum(timing.values())
+    return timing
 
 
 if __name__ == '__main__':
     print(sys.argv)
-    print(sys.platform)
\ No newline at end of file
+    print(sys.platform)
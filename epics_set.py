@@ -1 +1,131 @@
-import epics
+import threading
+import time
+
+import pv_backend
+
+
+class BatchedWriter:
+    # 把 (pv, value) 更新流合并后批量写入 IOC
+    # 同一 window 内对同一 PV 的多次写入只保留最后一次，每个 window 发出一次 caput_many
+    # pv_rate: 每个 PV 每秒最多写入次数；global_rate: 所有 PV 每秒最多写入次数；None 表示不限
+    # 被限速的写入留到下一个 window，期间的新值继续合并
+    # backend: 提供 caput_many(pvnames, values, wait=False) 的模块或对象，见 pv_backend.get
+    def __init__(self, window=0.01, pv_rate=None, global_rate=None, backend=None):
+        self.window = window
+        self.pv_interval = 1.0 / pv_rate if pv_rate else 0.0
+        self.global_rate = global_rate
+        self.backend = pv_backend.get(backend)
+
+        self.pending = {}  # pvname -> (value, submit_time)
+        self.last_put = {}  # pvname -> put_time
+        self.tokens = self.bucket_size = max(1.0, global_rate * window) if global_rate else 0.0
+        self.last_refill = time.monotonic()
+
+        self.submitted = 0
+        self.coalesced = 0
+        self.deferred = 0
+        self.puts = 0
+        self.batches = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def submit(self, pvname, value):
+        with self._lock:
+            self.submitted += 1
+            if pvname in self.pending:
+                self.coalesced += 1
+            self.pending[pvname] = (value, time.monotonic())
+
+    def start(self):
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        # 最后的设定值不能丢，忽略限速写出
+        self.flush(force=True)
+        return self.stats()
+
+    def _loop(self):
+        # pyepics 的工作线程需要加入主线程的 CA context
+        ca = getattr(self.backend, 'ca', None)
+        if ca is not None:
+            ca.use_initial_context()
+
+        next_flush = time.monotonic()
+        while not self._stop_event.is_set():
+            self.flush()
+            next_flush += self.window
+            self._stop_event.wait(max(next_flush - time.monotonic(), 0.0))
+
+    def _take(self, now, force=False):
+        # 选出本 window 可以写入的 PV，先提交的优先
+        if force:
+            batch = [(pvname, value, submit_time) for pvname, (value, submit_time) in self.pending.items()]
+            self.pending = {}
+            return batch
+
+        if self.global_rate:
+            self.tokens = min(self.bucket_size, self.tokens + (now - self.last_refill) * self.global_rate)
+            self.last_refill = now
+
+        batch = []
+        for pvname, (value, submit_time) in sorted(self.pending.items(), key=lambda item: item[1][1]):
+            if self.global_rate and self.tokens < 1.0:
+                break
+            if now - self.last_put.get(pvname, -self.pv_interval) < self.pv_interval:
+                continue
+            batch.append((pvname, value, submit_time))
+            if self.global_rate:
+                self.tokens -= 1.0
+
+        for pvname, _, _ in batch:
+            del self.pending[pvname]
+            self.last_put[pvname] = now
+        self.deferred += len(self.pending)
+        return batch
+
+    def flush(self, force=False):
+        with self._lock:
+            batch = self._take(time.monotonic(), force)
+        if not batch:
+            return 0
+
+        pvnames, values, submit_times = zip(*batch)
+        self.backend.caput_many(list(pvnames), list(values), wait=False)
+        put_time = time.monotonic()
+
+        self.puts += len(batch)
+        self.batches += 1
+        for submit_time in submit_times:
+            latency = put_time - submit_time
+            self.latency_sum += latency
+            self.latency_max = max(self.latency_max, latency)
+        return len(batch)
+
+    def stats(self):
+        return {
+            'submitted': self.submitted,
+            'coalesced': self.coalesced,
+            'deferred': self.deferred,
+            'pending': len(self.pending),
+            'puts': self.puts,
+            'batches': self.batches,
+            'latency_mean': self.latency_sum / self.puts if self.puts else 0.0,
+            'latency_max': self.latency_max,
+        }
@@ -0,0 +1,109 @@
+# 实验计算图的邻接索引，不依赖 Qt，编辑器和运行器共用
+# 节点可以是任意可哈希对象（DiagramItem 或节点 id）
+# 查询边 O(1)，增删节点和边时增量维护队首（没有输入）和队尾（没有输出）节点集合
+
+
+class GraphIndex:
+    def __init__(self):
+        self.succ = {}  # node -> {end: edge}
+        self.pred = {}  # node -> {start: edge}，按连线顺序排列，即 in_items 的顺序
+        self.sources = set()
+        self.sinks = set()
+
+    @classmethod
+    def from_edges(cls, nodes, edges):
+        graph = cls()
+        for node in nodes:
+            graph.add_node(node)
+        for start, end in edges:
+            graph.add_edge(start, end)
+        return graph
+
+    def __contains__(self, node):
+        return node in self.succ
+
+    def __len__(self):
+        return len(self.succ)
+
+    @property
+    def nodes(self):
+        return list(self.succ)
+
+    def add_node(self, node):
+        if node not in self.succ:
+            self.succ[node] = {}
+            self.pred[node] = {}
+            self.sources.add(node)
+            self.sinks.add(node)
+
+    def remove_node(self, node):
+        # 返回被一起删除的边
+        removed = [self.remove_edge(start, node) for start in list(self.pred[node])]
+        removed += [self.remove_edge(node, end) for end in list(self.succ[node])]
+        del self.succ[node]
+        del self.pred[node]
+        self.sources.discard(node)
+        self.sinks.discard(node)
+        return removed
+
+    def add_edge(self, start, end, edge=None):
+        self.add_node(start)
+        self.add_node(end)
+        self.succ[start][end] = edge
+        self.pred[end][start] = edge
+        self.sinks.discard(start)
+        self.sources.discard(end)
+
+    def remove_edge(self, start, end):
+        edge = self.succ[start].pop(end)
+        del self.pred[end][start]
+        if not self.succ[start]:
+            self.sinks.add(start)
+        if not self.pred[end]:
+            self.sources.add(end)
+        return edge
+
+    def has_edge(self, start, end):
+        return start in self.succ and end in self.succ[start]
+
+    def connected(self, node1, node2):
+        return self.has_edge(node1, node2) or self.has_edge(node2, node1)
+
+    def edges(self):
+        # (start, end, edge)，同一个 end 的边按连线顺序
+        return [(start, end, edge) for end, pred in self.pred.items() for start, edge in pred.items()]
+
+    def topological_order(self):
+        # Kahn 算法；有环时抛出异常
+        in_degree = {node: len(pred) for node, pred in self.pred.items()}
+        order = [node for node in self.succ if in_degree[node] == 0]
+        for node in order:
+            for end in self.succ[node]:
+                in_degree[end] -= 1
+                if in_degree[end] == 0:
+                    order.append(end)
+
+        if len(order) != len(self.succ):
+            raise Exception('Graph has a cycle.')
+        return order
+
+
+def upstream_order(roots, key, follow=None):
+    # 嵌套形式的计算图（节点 dict，上游在 in_items 中）：roots 及其所有上游节点按拓扑顺序排列，输入在前
+    # key(node): 节点的唯一标识；follow(node) 为 False 时不再展开该节点的上游
+    # 用显式的栈遍历，节点数多的计算图不会超出递归深度
+    nodes = {}
+    edges = []
+    stack = list(reversed(roots))
+    while stack:
+        node = stack.pop()
+        node_key = key(node)
+        if node_key in nodes:
+            continue
+        nodes[node_key] = node
+        if follow is None or follow(node):
+            edges += [(key(in_item), node_key) for in_item in node['in_items']]
+            stack += reversed(node['in_items'])
+
+    index = GraphIndex.from_edges(nodes, edges)
+    return [nodes[node_key] for node_key in index.topological_order()]
@@ -1,18 +1,21 @@
 import json
+import math
 import os
 import sys
 from copy import deepcopy as copy
 from typing import Any, Optional
-from src.model import *
+import runner
+import save_format
+from graph import GraphIndex
 
 import PySide2
-import numpy as np
-from PySide2.QtCore import (QPointF, QRectF, QSizeF, Qt, QLineF, )
-from PySide2.QtGui import (QIcon, QPen, QPolygonF, )
+from PySide2.QtCore import (QPointF, QRectF, QSizeF, Qt, QLineF, QTimer, )
+from PySide2.QtGui import (QColor, QIcon, QPen, QPolygonF, )
 from PySide2.QtWidgets import (QApplication, QCheckBox, QDoubleSpinBox, QGraphicsItem, QGraphicsLineItem,
                                QGraphicsTextItem, QLineEdit, QMainWindow, QMessageBox, QSpinBox,
                                QToolBox, QHBoxLayout, QGraphicsView, QGraphicsScene, QWidget, QToolButton, QComboBox,
-                               QFormLayout, QButtonGroup, QVBoxLayout, QLabel, QFileDialog, QAction)
+                               QFormLayout, QButtonGroup, QVBoxLayout, QLabel, QFileDialog, QAction, QProgressBar,
+                               QPlainTextEdit, QPushButton)
 
 # 功能
 # TODO train, run, save/load model
@@ -32,6 +35,7 @@ class Arrow(QGraphicsLineItem):
 
         self.arrow_size = 20.0
         self.arrow_head = QPolygonF()
+        self.geometry_key = None  # 上次计算箭头时两端item的位置和大小
 
         self.setFlag(QGraphicsItem.ItemIsSelectable, True)
         self.setPen(QPen(Qt.black, 2, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin))
@@ -52,69 +56,66 @@ class Arrow(QGraphicsLineItem):
 
     def update_position(self):
         # 当start_item 与 end_item 移动时更新箭头
-        start = self.mapFromItem(self.start_item, self.start_item.width() / 2, self.start_item.height() / 2)
-        end = self.mapFromItem(self.end_item, self.end_item.width() / 2, self.end_item.height() / 2)
-        self.setLine(QLineF(start, end))
-
-    def paint(self, painter: PySide2.QtGui.QPainter, option: PySide2.QtWidgets.QStyleOptionGraphicsItem,
-              widget: Optional[PySide2.QtWidgets.QWidget] = ...) -> None:
-        # 绘制直线和箭头
-
-        # pen 绘制轮廓，brush 填充
-        painter.setPen(self.pen())
-        painter.setBrush(Qt.black)
+        # 只在端点位置或大小变化时重新计算，结果缓存到 line 和 arrow_head 中供 paint 使用
+        key = (self.start_item.pos(), self.start_item.boundingRect(), self.end_item.pos(), self.end_item.boundingRect())
+        if key == self.geometry_key:
+            return
+        self.geometry_key = key
 
         if self.start_item.collidesWithItem(self.end_item):
             start_intersect_point = self.start_item.center_pos()
             end_intersect_point = self.end_item.center_pos()
-
         else:
-            # 遍历 item.polygon 每条边与直线的交点，寻找箭头的位置
             center_line = QLineF(self.start_item.center_pos(), self.end_item.center_pos())
-            end_polygon = self.end_item.polygon()
-            p1 = end_polygon.at(0) + self.end_item.pos()
-            end_intersect_point = QPointF()
-            for i in end_polygon:
-                p2 = i + self.end_item.pos()
-                poly_line = QLineF(p1, p2)
-                intersectType = poly_line.intersects(center_line, end_intersect_point)
-                if intersectType == QLineF.BoundedIntersection:
-                    break
-                p1 = p2
-
-            start_polygon = self.start_item.polygon()
-            p1 = start_polygon.at(0) + self.start_item.pos()
-            start_intersect_point = QPointF()
-            for i in start_polygon:
-                p2 = i + self.start_item.pos()
-                poly_line = QLineF(p1, p2)
-                intersectType = poly_line.intersects(center_line, start_intersect_point)
-                if intersectType == QLineF.BoundedIntersection:
-                    break
-                p1 = p2
-
-                # 绘制直线
+            start_intersect_point = self.intersect_point(self.start_item, center_line)
+            end_intersect_point = self.intersect_point(self.end_item, center_line)
+
+        # setLine 会调用 prepareGeometryChange，只刷新新旧 boundingRect 覆盖的区域
         self.setLine(QLineF(end_intersect_point, start_intersect_point))
 
-        # 绘制箭头
-        if self.line().length() == 0:
+        # 计算箭头
+        self.arrow_head = QPolygonF()
+        line = self.line()
+        if line.length() == 0:
             # 直线长度为0 不绘制箭头
-            # print('length 0', time.time())
             return
 
-        line = self.line()
-        angle = np.arccos(line.dx() / line.length())
+        angle = math.acos(line.dx() / line.length())
         if line.dy() >= 0:
-            angle = (np.pi * 2.0) - angle
-        arrow_head1 = QPointF(np.sin(angle + np.pi / 3.0) * self.arrow_size,
-                              np.cos(angle + np.pi / 3) * self.arrow_size)
-        arrow_p1 = line.p1() + arrow_head1  # 相对坐标转换为绝对坐标
-        arrow_head2 = QPointF(np.sin(angle + np.pi - np.pi / 3.0) * self.arrow_size,
-                              np.cos(angle + np.pi - np.pi / 3.0) * self.arrow_size)
-        arrow_p2 = line.p1() + arrow_head2  # 相对坐标转换为绝对坐标
-        self.arrow_head.clear()
-        for point in [line.p1(), arrow_p1, arrow_p2]:
+            angle = (math.pi * 2.0) - angle
+        arrow_head1 = QPointF(math.sin(angle + math.pi / 3.0) * self.arrow_size,
+                              math.cos(angle + math.pi / 3.0) * self.arrow_size)
+        arrow_head2 = QPointF(math.sin(angle + math.pi - math.pi / 3.0) * self.arrow_size,
+                              math.cos(angle + math.pi - math.pi / 3.0) * self.arrow_size)
+        # 相对坐标转换为绝对坐标
+        for point in [line.p1(), line.p1() + arrow_head1, line.p1() + arrow_head2]:
             self.arrow_head.append(point)
+
+    @staticmethod
+    def intersect_point(item, center_line: QLineF) -> QPointF:
+        # 遍历 item.polygon 每条边与直线的交点，寻找箭头的位置
+        polygon = item.polygon()
+        p1 = polygon.at(0) + item.pos()
+        intersect_point = QPointF()
+        for i in polygon:
+            p2 = i + item.pos()
+            poly_line = QLineF(p1, p2)
+            intersectType = poly_line.intersects(center_line, intersect_point)
+            if intersectType == QLineF.BoundedIntersection:
+                break
+            p1 = p2
+        return intersect_point
+
+    def paint(self, painter: PySide2.QtGui.QPainter, option: PySide2.QtWidgets.QStyleOptionGraphicsItem,
+              widget: Optional[PySide2.QtWidgets.QWidget] = ...) -> None:
+        # 绘制 update_position 缓存的直线和箭头
+        line = self.line()
+        if line.length() == 0:
+            return
+
+        # pen 绘制轮廓，brush 填充
+        painter.setPen(self.pen())
+        painter.setBrush(Qt.black)
         painter.drawLine(line)
         painter.drawPolygon(self.arrow_head)
 
@@ -127,34 +128,49 @@ class Arrow(QGraphicsLineItem):
             my_line.translate(0, -8.0)
             painter.drawLine(my_line)
 
-    def remove_item_list(self):
-        # 将自己从start_item 和 end_item 中的arrow list 删除
-        self.start_item.out_arrows.remove(self)
-        self.end_item.in_arrows.remove(self)
-
 
 class DiagramItem(QGraphicsTextItem):
 
-    def __init__(self, name, kwargs, pos, parent, dtype) -> None:
+    def __init__(self, name, kwargs, pos, parent, dtype, id) -> None:
         # text:
         # kwargs:
         # dtype: model, data, preprocess, loss, optimizer, hyperparameters
-        # id: 从0开始
+        # id: 从0开始, 保存文件中节点的稳定编号
         # pos
         # parent
         super(DiagramItem, self).__init__()
 
         self.dtype = dtype
+        self.id = id
 
         self.setPos(pos)
         self.setParent(parent)
         self.setFlag(QGraphicsItem.ItemIsMovable)  # 可以移动
         self.setFlag(QGraphicsItem.ItemIsSelectable)  # 可以选中
+        self.setFlag(QGraphicsItem.ItemSendsGeometryChanges)  # 移动时通知 itemChange
 
         self.setPlainText(name)
         self.kwargs = copy(kwargs)
-        self.in_arrows = []
-        self.out_arrows = []
+        self.problem = None
+
+    def set_problem(self, problem) -> None:
+        # problem: validate 的问题，None 表示没有问题
+        self.problem = problem
+        if problem is None:
+            self.setDefaultTextColor(Qt.black)
+            self.setToolTip('')
+        else:
+            self.setDefaultTextColor(Qt.red if problem['level'] == 'error' else QColor(255, 140, 0))
+            self.setToolTip(problem['message'])
+
+    @property
+    def in_arrows(self) -> list:
+        # 连线保存在 scene 的图索引中，按连线顺序
+        return list(self.parent().graph.pred.get(self, {}).values())
+
+    @property
+    def out_arrows(self) -> list:
+        return list(self.parent().graph.succ.get(self, {}).values())
 
     def center_pos(self) -> QPointF:
         # 返回item中心的绝对坐标
@@ -213,12 +229,12 @@ class DiagramItem(QGraphicsTextItem):
             property_layout.removeRow(0)
 
     def itemChange(self, change: PySide2.QtWidgets.QGraphicsItem.GraphicsItemChange, value: Any) -> Any:
-        if change == QGraphicsItem.ItemPositionChange:
-            # item 被移动
+        if change == QGraphicsItem.ItemPositionHasChanged:
+            # item 被移动，只更新与其相连的箭头
             for arrow in self.in_arrows:
-                arrow.updatePosition()
+                arrow.update_position()
             for arrow in self.out_arrows:
-                arrow.updatePosition()
+                arrow.update_position()
             self.parent().parent().saved = False
 
         elif change == QGraphicsItem.ItemSelectedChange:
@@ -239,17 +255,6 @@ class DiagramItem(QGraphicsTextItem):
 
         return super().itemChange(change, value)
 
-    def remove_arrow(self, arrow: Arrow) -> None:
-        arrow.remove_item_list()  # 将箭头从所连接的item list 中删除
-        self.parent().removeItem(arrow)  # 将箭头从scene中删除
-
-    def remove_arrows(self) -> None:
-        for arrow in self.in_arrows[:]:
-            self.remove_arrow(arrow)
-
-        for arrow in self.out_arrows[:]:
-            self.remove_arrow(arrow)
-
     def polygon(self) -> QPolygonF:
         rect = self.boundingRect()
         # top_left = rect.topLeft()
@@ -273,6 +278,7 @@ class DiagramScene(QGraphicsScene):
         self.line = None
         self.setParent(parent)
         self.item_count = 0
+        self.graph = GraphIndex()  # DiagramItem 之间连线的索引，edge 为 Arrow
 
     def mousePressEvent(self, event: PySide2.QtWidgets.QGraphicsSceneMouseEvent) -> None:
         if event.button() != Qt.LeftButton:  # 只响应左键
@@ -281,8 +287,9 @@ class DiagramScene(QGraphicsScene):
         # 摁下左键：添加item 或 临时显示line 或 无动作
         if self.item_text and self.pointer_mode == 'pointer':
             # 添加item
-            item = DiagramItem(self.item_text + '_' + str(self.item_count), self.item_kwargs, event.scenePos(), self, self.dtype)
-            self.addItem(item)
+            item = DiagramItem(self.item_text + '_' + str(self.item_count), self.item_kwargs, event.scenePos(), self,
+                               self.dtype, self.item_count)
+            self.add_diagram_item(item)
             self.item_count += 1
 
             self.parent().saved = False
@@ -327,31 +334,153 @@ class DiagramScene(QGraphicsScene):
             self.line = None
 
             if (len(start_items) and len(end_items)) and (
+                    isinstance(start_items[0], DiagramItem) and isinstance(end_items[0], DiagramItem)) and (
                     start_items[0] != end_items[0] and (not self.items_connected(start_items[0], end_items[0]))):
                 # 两个item存在 且 不相同 且 未连线
-                arrow = Arrow(start_items[0], end_items[0])
-                start_items[0].out_arrows.append(arrow)
-                end_items[0].in_arrows.append(arrow)
-                self.addItem(arrow)
-                arrow.update_position()
+                self.add_arrow(start_items[0], end_items[0])
 
                 self.parent().saved = False
 
         super().mouseReleaseEvent(event)
 
     def items_connected(self, item1: DiagramItem, item2: DiagramItem) -> bool:
-        # 判断两个item是否连线
-        # item1 <- item2: 查找item1 in_arrows list 与 item2 out_arrows list 中是否有相同的arrow
-        for arrow1 in item1.in_arrows:
-            if arrow1 in item2.out_arrows:
-                return True
+        # 判断两个item是否连线（任意方向）
+        return self.graph.connected(item1, item2)
 
-        # item1 -> item2: 查找item1 out_arrows list 与 item2 in_arrows list 中是否有相同的arrow
-        for arrow2 in item2.in_arrows:
-            if arrow2 in item1.out_arrows:
-                return True
+    def add_diagram_item(self, item: DiagramItem) -> None:
+        self.addItem(item)
+        self.graph.add_node(item)
 
-        return False
+    def add_arrow(self, start_item: DiagramItem, end_item: DiagramItem) -> Arrow:
+        arrow = Arrow(start_item, end_item)
+        self.graph.add_edge(start_item, end_item, arrow)
+        self.addItem(arrow)
+        arrow.update_position()
+        return arrow
+
+    def remove_arrow(self, arrow: Arrow) -> None:
+        # 箭头可能已经随所连接的item一起删除
+        if self.graph.has_edge(arrow.start_item, arrow.end_item):
+            self.graph.remove_edge(arrow.start_item, arrow.end_item)
+            self.removeItem(arrow)
+
+    def mark_problems(self, problems) -> None:
+        # 每个节点只显示第一个问题，error 优先
+        by_id = {}
+        for problem in sorted(problems, key=lambda problem: problem['level'] != 'error'):
+            by_id.setdefault(problem['id'], problem)
+        for item in self.graph.nodes:
+            item.set_problem(by_id.get(item.id))
+
+    def remove_diagram_item(self, item: DiagramItem) -> None:
+        # 删除item前删除所连接的所有箭头
+        for arrow in self.graph.remove_node(item):
+            self.removeItem(arrow)
+        self.removeItem(item)
+
+
+class RunPanel(QWidget):
+    # 显示后台运行（runner.Run）的进度，定时从进程间队列取事件，不阻塞界面线程
+    def __init__(self):
+        super().__init__()
+        self.run = None
+        self.batches = 0
+        self.on_problems = None  # 运行中形状检查出错时，用 problems 调用
+
+        self.status = QLabel('idle')
+        self.progress_bar = QProgressBar()
+        self.log = QPlainTextEdit()
+        self.log.setReadOnly(True)
+        self.log.setMaximumBlockCount(1000)
+        self.cancel_button = QPushButton('Cancel')
+        self.cancel_button.setEnabled(False)
+        self.cancel_button.clicked.connect(self.cancel)
+
+        layout = QVBoxLayout()
+        layout.addWidget(self.status)
+        layout.addWidget(self.progress_bar)
+        layout.addWidget(self.log)
+        layout.addWidget(self.cancel_button)
+        self.setLayout(layout)
+
+        self.timer = QTimer(self)
+        self.timer.setInterval(100)
+        self.timer.timeout.connect(self.poll)
+
+    def running(self) -> bool:
+        return self.run is not None and not self.run.finished
+
+    def start(self, path) -> bool:
+        if self.running():
+            print('Error! Experiment is already running.')
+            return False
+
+        self.run = runner.Run(path).start()
+        self.log.clear()
+        self.progress_bar.reset()
+        self.status.setText('starting')
+        self.cancel_button.setText('Cancel')
+        self.cancel_button.setEnabled(True)
+        self.timer.start()
+        return True
+
+    def cancel(self):
+        if not self.running():
+            return
+        if self.run.stop_event.is_set():
+            # 第二次点击：强制结束
+            self.run.kill()
+        else:
+            self.run.cancel()
+            self.status.setText('cancelling')
+            self.cancel_button.setText('Kill')
+
+    def stop(self):
+        if self.running():
+            self.run.kill()
+
+    def poll(self):
+        for event in self.run.poll():
+            self.show_event(event)
+
+        if self.run.finished:
+            self.timer.stop()
+            self.cancel_button.setEnabled(False)
+
+    def show_event(self, event):
+        kind = event['event']
+        if kind == 'start':
+            self.batches = event['batches'] or 0
+            # 流式数据没有固定的 batch 数，进度条只按 epoch 显示
+            self.progress_bar.setRange(0, event['epochs'] * max(self.batches, 1))
+            # 从检查点继续时进度从已完成的 epoch 开始
+            self.progress_bar.setValue(event.get('start_epoch', 0) * max(self.batches, 1))
+            self.status.setText('running')
+
+        elif kind == 'batch':
+            self.status.setText(f"epoch: {event['epoch']}, batch: {event['batch']}, loss: {event['loss']:.6g}, "
+                                f"{event['samples_per_second']:.0f} samples/s")
+            if self.batches:
+                self.progress_bar.setValue(event['epoch'] * self.batches + event['batch'] + 1)
+
+        elif kind == 'epoch':
+            # loss, accuracy, epoch_time 由 hyperparameter 节点的选项决定是否存在
+            text = f"epoch: {event['epoch']}, {event['samples_per_second']:.0f} samples/s"
+            for k in ['loss', 'accuracy', 'epoch_time']:
+                if k in event:
+                    text += f", {k}: {event[k]:.6g}"
+            self.log.appendPlainText(text)
+            self.progress_bar.setValue((event['epoch'] + 1) * max(self.batches, 1))
+
+        elif kind == 'error':
+            self.status.setText('error')
+            self.log.appendPlainText(event['message'])
+            if event.get('problems') and self.on_problems is not None:
+                self.on_problems(event['problems'])
+
+        else:
+            # done, cancelled
+            self.status.setText(kind)
 
 
 class MainWindow(QMainWindow):
@@ -361,7 +490,7 @@ class MainWindow(QMainWindow):
 
         self.module_path = 'modules.json'
         self.save_file_path = None
-        self.save_version = "0.1.0"
+        self.save_version = save_format.SAVE_VERSION
         self.saved = True
 
         # 初始化
@@ -371,13 +500,19 @@ class MainWindow(QMainWindow):
         self.init_toolbar()
         self.init_tool_box()
         self.init_property_box()
+        self.run_panel = RunPanel()
+        self.run_panel.on_problems = self.scene.mark_problems
         self.init_layout()
 
     def init_layout(self):
         layout = QHBoxLayout()
         layout.addWidget(self.tool_box)
         layout.addWidget(self.view)
-        layout.addWidget(self.property_box)
+
+        right_layout = QVBoxLayout()
+        right_layout.addWidget(self.property_box)
+        right_layout.addWidget(self.run_panel)
+        layout.addLayout(right_layout)
 
         widget = QWidget()
         widget.setLayout(layout)
@@ -446,6 +581,7 @@ class MainWindow(QMainWindow):
         pointer_toolbar.addWidget(scene_scale_combo)
 
         run_toolbar = self.addToolBar('Run')
+        run_toolbar.addAction(self.validate_action)
         run_toolbar.addAction(self.run_action)
 
     def init_tool_box(self):
@@ -510,6 +646,7 @@ class MainWindow(QMainWindow):
         self.scene = DiagramScene(self)
         self.scene.setSceneRect(QRectF(0, 0, 5000, 5000))
         self.view = QGraphicsView(self.scene)
+        self.view.setViewportUpdateMode(QGraphicsView.MinimalViewportUpdate)  # 只重绘变化的区域
 
     def init_action(self):
         self.new_action = QAction('New', triggered=self.new)
@@ -519,37 +656,32 @@ class MainWindow(QMainWindow):
         self.delete_action = QAction('Delete', triggered=self.delete)
         self.exit_action = QAction('Exit', triggered=self.exit)
         self.run_action = QAction('Run', triggered=self.run)
+        self.validate_action = QAction('Validate', triggered=self.validate)
+
+    def validate(self) -> bool:
+        # 不读取数据检查形状，有问题的节点标红，问题显示在节点的提示和运行面板中
+        # 在界面线程中执行，第一次需要导入 torch；Run 不调用这里，由后台进程中的 DL 检查
+        import validate
+
+        problems, _ = validate.validate(save_format.nest(self.to_json()))
+        self.scene.mark_problems(problems)
+        self.run_panel.log.clear()
+        self.run_panel.log.appendPlainText(validate.format_problems(problems) or 'No problems.')
+        return not validate.errors(problems)
 
     def run(self):
         if not self.save():
             print('运行失败')
             return False
 
-        with open(self.save_file_path) as f:
-            js_file = json.load(f)
-
-        # 检测版本
-        if js_file['save_version'] != self.save_version:
-            print('Warning! Different save version.')
-
-        if js_file['module_version'] != self.module_version:
-            print('Warning! Different module version.')
-
-        f = None
-        for model in js_file['models']:
-            if model['dtype'] == 'hyperparameters':
-                if not f:
-                    f = eval(model['kwargs']['func'])
-                else:
-                    print('Error! More than one hyperparameter model.')
-                    return False
-
-        if f is None:
-            print('Error! No hyperparameter model.')
-
-        f(js_file['models'])
+        # 在后台进程中运行，进度显示在 run_panel 中；DL 在读取数据之前检查形状，
+        # 有错误时通过 error 事件发回，由 run_panel.on_problems 标出有问题的节点
+        self.scene.mark_problems([])
+        if not self.run_panel.start(self.save_file_path):
+            print('运行失败')
+            return False
 
-        print('运行成功')
+        print('开始运行')
         return True
 
     def new(self):
@@ -562,20 +694,6 @@ class MainWindow(QMainWindow):
             print("新建失败")
 
     def open(self):
-        def add_item(model):
-            item = DiagramItem(model['name'], model['kwargs'], QPointF(*model['pos']), self.scene, model['dtype'])    
-            self.scene.addItem(item)
-
-            for item_kwargs in model['in_items']:
-                in_item = add_item(item_kwargs)
-                
-                arrow = Arrow(in_item, item)
-                in_item.out_arrows.append(arrow)
-                item.in_arrows.append(arrow)
-                self.scene.addItem(arrow)
-                arrow.update_position()
-
-            return item
         # 选择文件
         file_name = QFileDialog.getOpenFileName(self, 'open file', '.')[0]
         
@@ -584,21 +702,25 @@ class MainWindow(QMainWindow):
             return False
 
         if self.saved or self.close():
-            # 读取文件
-            with open(file_name) as f:
-                models = json.load(f)
-
-            if models['save_version'] != self.save_version:
-                print('Warning! Different save version.')
+            # 读取文件，旧版本自动升级
+            js = save_format.load(file_name)
 
-            if models['module_version'] != self.module_version:
+            if js['module_version'] != self.module_version:
                 print('Warning! Different module version.')
 
-            self.scene.item_count = models['scene']['item_count']
+            # 新建item的编号不能与已有的重复
+            self.scene.item_count = max([js['scene']['item_count']] + [node['id'] + 1 for node in js['nodes']])
 
             # 创建item, arrow
-            for model in models['models']:
-                add_item(model)
+            items = {}
+            for node in js['nodes']:
+                item = DiagramItem(node['name'], node['kwargs'], QPointF(*node['pos']), self.scene, node['dtype'],
+                                   node['id'])
+                self.scene.add_diagram_item(item)
+                items[node['id']] = item
+
+            for start, end in js['edges']:
+                self.scene.add_arrow(items[start], items[end])
 
             self.save_file_path = file_name
             self.saved = True
@@ -609,18 +731,7 @@ class MainWindow(QMainWindow):
             print('打开失败')
             return False
 
-    def save(self):
-        def traverse(item: DiagramItem) -> dict:
-            # 保存自己
-            ret = {
-                'name': item.toPlainText(),
-                'dtype': item.dtype,
-                'pos': [item.pos().x(), item.pos().y()],
-                'kwargs': item.kwargs,
-                'in_items': [traverse(arrow.start_item) for arrow in item.in_arrows],
-            }
-            return ret
-
+    def to_json(self) -> dict:
         js = {}
         js['save_version'] = self.save_version
         js['module_version'] = self.module_version
@@ -630,13 +741,20 @@ class MainWindow(QMainWindow):
         js['scene'] = {}
         js['scene']['item_count'] = scene.item_count
 
-        # 保存item
-        js['models'] = []
+        # 保存item：每个节点只保存一次，连线保存为边
+        items = sorted(scene.graph.nodes, key=lambda item: item.id)
+        js['nodes'] = [{
+            'id': item.id,
+            'name': item.toPlainText(),
+            'dtype': item.dtype,
+            'pos': [item.pos().x(), item.pos().y()],
+            'kwargs': item.kwargs,
+        } for item in items]
+        js['edges'] = [[start.id, end.id] for start, end, _ in scene.graph.edges()]
+        return js
 
-        for item in scene.items():
-            if isinstance(item, DiagramItem) and len(item.out_arrows) == 0:
-                # 找到队尾item
-                js['models'].append(traverse(item))
+    def save(self):
+        js = self.to_json()
 
         # 保存
         # 检查self.save_file_path，如果为None则提示输入文件名
@@ -664,22 +782,24 @@ class MainWindow(QMainWindow):
     def delete(self):
         for item in self.scene.selectedItems():
             if isinstance(item, DiagramItem):
-                # 删除item前删除所连接的所有箭头
-                item.remove_arrows()
+                self.scene.remove_diagram_item(item)
             elif isinstance(item, Arrow):
-                # 删除箭头前将自己从所连接的item中删除
-                item.remove_item_list()
+                self.scene.remove_arrow(item)
             else:
                 print('删除错误：', type(item))
 
-            self.scene.removeItem(item)
-
         self.saved = False
 
     def exit(self):
         if self.close() == True:
+            self.run_panel.stop()
             sys.exit(0)
 
+    def closeEvent(self, event):
+        # 后台运行的进程不是 daemon 进程，退出前结束它
+        self.run_panel.stop()
+        super().closeEvent(event)
+
     def close(self):
         # 检测是否保存，如果未保存则提示保存
         if not self.saved:
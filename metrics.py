@@ -0,0 +1,66 @@
+import json
+import time
+
+import torch
+
+# 训练指标：每个 batch 只在 device 上累加，不调用 .item()，每个 epoch 同步一次
+# 由 hyperparameter 节点的 epoch_loss / accuracy / epoch_time 决定记录哪些指标
+
+
+def count_correct(y_pred, y_true):
+    # 多列输出按 argmax 分类（y_true 为类别下标或 one-hot）；单列输出四舍五入后与 y_true 比较
+    if y_pred.dim() > 1 and y_pred.size(1) > 1:
+        if y_true.dim() > 1 and y_true.size(1) > 1:
+            y_true = y_true.argmax(dim=1)
+        return (y_pred.argmax(dim=1) == y_true.reshape(-1)).sum()
+    return (y_pred.round().reshape(-1) == y_true.reshape(-1)).sum()
+
+
+class Metrics:
+    def __init__(self, device, epoch_loss=True, accuracy=False, epoch_time=True, path=None, resume=False):
+        self.device = device
+        self.epoch_loss = epoch_loss
+        self.accuracy = accuracy
+        self.epoch_time = epoch_time
+        self.path = path  # jsonl 文件，None 表示不写文件
+        if path and not resume:
+            # 每次运行重新开始记录，从检查点继续时接着写
+            open(path, 'w').close()
+        self.reset()
+
+    def reset(self):
+        self.loss_sum = torch.zeros((), device=self.device)
+        self.correct = torch.zeros((), device=self.device, dtype=torch.long)
+        self.samples = 0
+        self.batches = 0
+        self.tic = time.time()
+
+    def update(self, loss, y_pred, y_true):
+        # loss 为 batch 的平均值，按样本数加权累加
+        n = len(y_true)
+        self.samples += n
+        self.batches += 1
+        if self.epoch_loss:
+            self.loss_sum += loss.detach() * n
+        if self.accuracy:
+            self.correct += count_correct(y_pred.detach(), y_true)
+
+    def epoch(self, epoch) -> dict:
+        # 一次同步取出本 epoch 的所有指标，写入 jsonl，然后清零
+        elapsed = time.time() - self.tic
+        loss_sum, correct = torch.stack([self.loss_sum, self.correct.to(self.loss_sum.dtype)]).tolist()
+
+        record = {'epoch': epoch, 'samples': self.samples, 'batches': self.batches,
+                  'samples_per_second': self.samples / elapsed if elapsed else 0.0}
+        if self.epoch_loss:
+            record['loss'] = loss_sum / max(self.samples, 1)
+        if self.accuracy:
+            record['accuracy'] = correct / max(self.samples, 1)
+        if self.epoch_time:
+            record['epoch_time'] = elapsed
+
+        if self.path:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        self.reset()
+        return record
@@ -1,15 +1,28 @@
 import time
 
 import torch
-from torch.utils.data import DataLoader, TensorDataset
-import epics_set
-import epics_get
+from torch.utils.data import BatchSampler, DataLoader, RandomSampler, SequentialSampler
+import batching
+import checkpoint
+import dag
+import graph
+import metrics
+import parallel
+import profiler
+import registry
+import stream
+import tensor_store
+import validate
+
+def resolve(name):
+    # 只解析 modules.json 中登记的函数，模块在第一次使用时才导入，见 registry
+    return registry.resolve(name)
 
-# TODO 显示loss accuracy epoch batch
 
 def call(kwargs: dict, **kwargs_):
-    kwargs.update(kwargs_)
-    f = eval(kwargs.pop('func'))
+    # 不修改节点的 kwargs，同一个计算图可以重复构建
+    kwargs = dict(kwargs, **kwargs_)
+    f = resolve(kwargs.pop('func'))
     return f(**kwargs)
 
 
@@ -26,35 +39,196 @@ def set_device(gpu):
     return device
 
 
-def build_net(net_model):
-    layers = [call(net_model['kwargs'])]
-
-    while net_model['in_items'][0]['dtype'] == 'model':
-        net_model = net_model['in_items'][0]
-        layers.append(call(net_model['kwargs']))
-
-    net = torch.nn.Sequential(*layers[::-1])
+def build_layer(model):
+    with profiler.section('build', model['name']):
+        return call(model['kwargs'])
 
-    x_train = build_data(net_model['in_items'][0])
 
-    return net, x_train
+def in_net(model, memo=None):
+    # 网络部分：model 节点，以及输入中有网络输出的 preprocess 节点（如合并分支的 cat）
+    # memo: node key -> 结果，有共享节点的大计算图中每个节点只判断一次
+    memo = {} if memo is None else memo
+    key = node_key(model)
+    if key not in memo:
+        # 只有 preprocess 节点需要看上游，按拓扑顺序判断，上游先于下游
+        follow = lambda node: node['dtype'] == 'preprocess' and node_key(node) not in memo
+        for node in graph.upstream_order([model], node_key, follow):
+            if node_key(node) not in memo:
+                memo[node_key(node)] = node['dtype'] == 'model' or (
+                    node['dtype'] == 'preprocess' and any(memo[node_key(in_item)] for in_item in node['in_items']))
+    return memo[key]
+
+
+def chain(net_model):
+    # 网络只是单输入 model 节点的串联时，返回从输出到输入的节点列表，否则返回 None
+    layers = [net_model]
+    while layers[-1]['dtype'] == 'model' and len(layers[-1]['in_items']) == 1:
+        if not in_net(layers[-1]['in_items'][0]):
+            return layers
+        layers.append(layers[-1]['in_items'][0])
+    return None
+
+
+def net_inputs(net_model):
+    # 网络的输入节点
+    layers = chain(net_model)
+    if layers is not None:
+        return [layers[-1]['in_items'][0]]
+    memo = {}
+    return dag.collect(net_model, lambda node: in_net(node, memo), node_key)[0]
+
+
+def build_net(net_model, cache=None, concurrent=False):
+    # 串联的网络构建为 Sequential，有分支或多个输入时编译为 dag.GraphModule
+    layers = chain(net_model)
+    if layers is not None:
+        net = torch.nn.Sequential(*[build_layer(layer) for layer in layers][::-1])
+        x_train = build_data(layers[-1]['in_items'][0], cache)
+        return net, x_train
+
+    memo = {}
+    inputs, steps = dag.compile_net(net_model, lambda node: in_net(node, memo), build_layer, resolve, node_key)
+    xs = [build_data(node, cache) for node in inputs]
+    if len(xs) == 1:
+        return dag.GraphModule(1, steps, concurrent=concurrent), xs[0]
+
+    # 多个输入拼接成一个，数据加载不需要区分
+    if any(isinstance(x, stream.Stream) for x in xs):
+        raise Exception('Net with several inputs needs tensor data.')
+    widths = [x.size(1) for x in xs]
+    return dag.GraphModule(len(xs), steps, widths, concurrent), cat(in_items=xs, dim=1)
 
 
 def cat(**kwargs):
     kwargs['tensors'] = tuple(kwargs.pop('in_items'))
+    if any(isinstance(t, stream.Stream) for t in kwargs['tensors']):
+        # 流式数据按块对齐后拼接
+        return stream.cat(kwargs['tensors'], kwargs.get('dim', 0))
+    if kwargs.get('dim') in (1, -1) and any(tensor_store.is_mapped(t) for t in kwargs['tensors']):
+        # 内存映射的列不在内存中拼接，训练时按batch读取
+        return tensor_store.MappedTable(kwargs['tensors'])
+    # 其余方向的拼接读入内存
+    kwargs['tensors'] = tuple(tensor_store.read_rows(t, slice(None)) if tensor_store.is_mapped(t) else t
+                              for t in kwargs['tensors'])
     return torch.cat(**kwargs)
 
 
-def build_data(model):
-    # model: data 或 preprocess
-    if model['dtype'] == 'preprocess':
-        in_items = [build_data(in_item) for in_item in model['in_items']]
-        return call(model['kwargs'], in_items=in_items)
-    elif model['dtype'] == 'data':
-        return call(model['kwargs'])
+def build_loader(x, y, device, batch_size, shuffle, prefetch=4, steps=None):
+    if isinstance(x, stream.Stream) or isinstance(y, stream.Stream):
+        # 流式训练：数据由后台线程按batch预取，batch 已经切好
+        return DataLoader(stream.StreamDataset(x, y, batch_size, prefetch, steps), batch_size=None)
+
+    if tensor_store.is_mapped(x) or tensor_store.is_mapped(y):
+        # 数据留在磁盘映射中，每个batch按下标一次读取，再拷贝到device
+        dataset = tensor_store.MappedDataset(x, y)
+        sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+        return DataLoader(dataset, sampler=BatchSampler(sampler, batch_size, drop_last=False), batch_size=None)
+
+    # 内存中的 tensor 直接切片，不经过 DataLoader
+    return batching.TensorBatches((x.to(device), y.to(device)), batch_size, shuffle)
+
+
+def batch_count(loader):
+    # 流式数据没有固定的 batch 数
+    try:
+        return len(loader)
+    except TypeError:
+        return None
+
+
+def node_key(model):
+    # 0.2.0 保存格式的节点有稳定的 id；直接传入的嵌套 0.1.0 格式中共享的节点会在
+    # 每个使用者的 in_items 中各出现一次，用名字识别同一个节点
+    return model.get('id', model['name'])
 
 
-def DL(*args, **kwargs):
+class NodeCache:
+    # 计算图求值时每个节点只计算一次
+    # 结果按使用者计数，最后一个使用者取走后立即释放
+    # prebuilt: node key -> 已经构建好的结果（如超参数搜索中各次训练共享的数据），这些节点不再计算
+    def __init__(self, roots, prebuilt=None):
+        self.consumers = {}  # key -> 剩余使用者数
+        self.values = dict(prebuilt or {})
+        self.evaluations = 0
+
+        for root in roots:
+            self.consumers[node_key(root)] = self.consumers.get(node_key(root), 0) + 1
+        for model in graph.upstream_order(roots, node_key):
+            for in_item in model['in_items']:
+                self.consumers[node_key(in_item)] = self.consumers.get(node_key(in_item), 0) + 1
+
+    def __contains__(self, model):
+        return node_key(model) in self.values
+
+    def put(self, model, value):
+        self.values[node_key(model)] = value
+        self.evaluations += 1
+
+    def take(self, model):
+        # 使用者取走结果
+        key = node_key(model)
+        value = self.values[key]
+        self.consumers[key] -= 1
+        if self.consumers[key] <= 0:
+            del self.values[key]
+        return value
+
+
+def build_data(model, cache=None):
+    # model: data 或 preprocess
+    # 按拓扑顺序逐个计算还没有结果的上游节点，不递归，节点数多的计算图也不会超出递归深度
+    if cache is None:
+        cache = NodeCache([model])
+
+    for node in graph.upstream_order([model], node_key, lambda node: node not in cache):
+        if node in cache:
+            continue
+        kwargs = {}
+        if node['dtype'] == 'preprocess':
+            kwargs['in_items'] = [cache.take(in_item) for in_item in node['in_items']]
+        elif node['dtype'] != 'data':
+            cache.put(node, None)
+            continue
+        # 每个节点只统计自己的耗时
+        with profiler.section(node['dtype'], node['name']) as output:
+            output['value'] = call(node['kwargs'], **kwargs)
+        cache.put(node, output['value'])
+
+    return cache.take(model)
+
+
+class Cancelled(Exception):
+    pass
+
+
+class Progress:
+    # 训练进度事件，发送给 callback（如 runner 的进程间队列）
+    # batch 事件按 interval 秒节流，其余事件立即发送
+    def __init__(self, callback=None, interval=0.5):
+        self.callback = callback
+        self.interval = interval
+        self.last = time.time()
+        self.samples = 0
+
+    def emit(self, event, **kwargs):
+        if self.callback is not None:
+            self.callback(dict(event=event, time=time.time(), **kwargs))
+
+    def due(self, samples):
+        # 累计样本数，到了发送时间返回 True
+        self.samples += samples
+        return self.callback is not None and time.time() - self.last >= self.interval
+
+    def batch(self, **kwargs):
+        now = time.time()
+        self.emit('batch', samples_per_second=self.samples / (now - self.last), **kwargs)
+        self.last = now
+        self.samples = 0
+
+
+def DL(*args, progress=None, should_stop=None, prebuilt=None, **kwargs):
+    # progress: 接收进度事件 dict 的函数；should_stop: 返回 True 时在下一个 batch 前取消训练
+    # prebuilt: 见 NodeCache
     models = args[0]
 
     for model in models:
@@ -64,15 +238,58 @@ def DL(*args, **kwargs):
             optimizer_model = model
 
     # hyperparameter
-    EPOCH = hyperparameters_model['kwargs']['epoch']
-    BATCH_SIZE = hyperparameters_model['kwargs']['batch_size']
-    SHUFFLE = hyperparameters_model['kwargs']['shuffle']
     GPU = hyperparameters_model['kwargs']['gpu']
     SEED = hyperparameters_model['kwargs']['seed']
     MODEL_PATH = hyperparameters_model['kwargs']['model_path']
+    PROFILE = hyperparameters_model['kwargs'].get('profile', False)
     set_seed(SEED)
     device = set_device(GPU)
 
+    if PROFILE:
+        profiler.current = profiler.Profiler(device)
+        try:
+            return train(models, hyperparameters_model, optimizer_model, device, progress, should_stop, prebuilt)
+        finally:
+            profiler.current.remove_hooks()
+            if MODEL_PATH:
+                profiler.current.save(MODEL_PATH + '.profile.txt')
+                print('Profile saved in', MODEL_PATH + '.profile.txt')
+            else:
+                print(profiler.current.report())
+            profiler.current = None
+
+    return train(models, hyperparameters_model, optimizer_model, device, progress, should_stop, prebuilt)
+
+
+def train(models, hyperparameters_model, optimizer_model, device, progress=None, should_stop=None, prebuilt=None):
+    # hyperparameter
+    EPOCH = hyperparameters_model['kwargs']['epoch']
+    BATCH_SIZE = hyperparameters_model['kwargs']['batch_size']
+    SHUFFLE = hyperparameters_model['kwargs']['shuffle']
+    MODEL_PATH = hyperparameters_model['kwargs']['model_path']
+    PREFETCH = hyperparameters_model['kwargs'].get('prefetch', 4)
+    STEPS = hyperparameters_model['kwargs'].get('steps') or None  # 0 表示读完整个流
+    REPORT_INTERVAL = hyperparameters_model['kwargs'].get('report_interval', 0.5)
+    EPOCH_LOSS = hyperparameters_model['kwargs'].get('epoch_loss', True)
+    ACCURACY = hyperparameters_model['kwargs'].get('accuracy', False)
+    EPOCH_TIME = hyperparameters_model['kwargs'].get('epoch_time', True)
+    # 默认与模型保存在一起
+    METRICS_PATH = hyperparameters_model['kwargs'].get('metrics_path') or (
+        MODEL_PATH + '.metrics.jsonl' if MODEL_PATH else None)
+    CHECKPOINT_EVERY = hyperparameters_model['kwargs'].get('checkpoint_every', 0)  # 0 表示不保存检查点
+    KEEP_LAST = hyperparameters_model['kwargs'].get('keep_last', 3)
+    RESUME = hyperparameters_model['kwargs'].get('resume', False)
+    if (CHECKPOINT_EVERY or RESUME) and not MODEL_PATH:
+        raise Exception('Checkpoint needs model_path.')
+    WORKERS = hyperparameters_model['kwargs'].get('workers', 0)  # 大于 1 时多进程数据并行
+    CONCURRENT_BRANCHES = hyperparameters_model['kwargs'].get('concurrent_branches', False)
+    VALIDATE = hyperparameters_model['kwargs'].get('validate', True)
+
+    if VALIDATE:
+        # 读取数据之前在 meta tensor 上检查形状，见 validate
+        errors = validate.errors(validate.validate(models)[0])
+        if errors:
+            raise validate.ValidationError(errors)
 
     # build model
     if len(optimizer_model['in_items']) == 1 and optimizer_model['in_items'][0]['dtype'] == 'loss':
@@ -84,39 +301,79 @@ def DL(*args, **kwargs):
     if len(loss_model['in_items']) != 2:
         raise Exception('Wrong in_items of optimizer.')
 
+    cache = NodeCache([loss_model], prebuilt)
     for model in loss_model['in_items']:
-        if model['dtype'] in ['data', 'preprocess']:
-            y_true = build_data(model)
-        elif model['dtype'] == 'model':
-            net, x_true = build_net(model)
+        if in_net(model):
+            net, x_true = build_net(model, cache, CONCURRENT_BRANCHES)
+        else:
+            y_true = build_data(model, cache)
+
+    if WORKERS > 1:
+        # 数据在这里构建一次，由各个进程共享，见 parallel
+        return parallel.train(net, x_true, y_true, hyperparameters_model, optimizer_model, loss_model, WORKERS,
+                              progress, should_stop)
 
     net.to(device)
+    if profiler.current is not None and isinstance(net, (torch.nn.Sequential, dag.GraphModule)):
+        profiler.current.hook_layers(net)
 
     optimizer = call(optimizer_model['kwargs'], params=net.parameters())
     loss_func = call(loss_model['kwargs'])
 
     # dataloader
-    dataset = TensorDataset(x_true.to(device), y_true.to(device))
-    dataloader = DataLoader(dataset, batch_size=BATCH_SIZE, shuffle=SHUFFLE)
+    dataloader = build_loader(x_true, y_true, device, BATCH_SIZE, SHUFFLE, PREFETCH, STEPS)
+
+    start_epoch = checkpoint.resume(checkpoint.directory(MODEL_PATH), net, optimizer) if RESUME else 0
 
-    for epoch in range(EPOCH):
-        tic = time.time()
-        total_loss = 0
+    checkpointer = checkpoint.Checkpointer(checkpoint.directory(MODEL_PATH), KEEP_LAST) if CHECKPOINT_EVERY else None
+    try:
+        train_epochs(net, optimizer, loss_func, dataloader, device, range(start_epoch, EPOCH), checkpointer,
+                     CHECKPOINT_EVERY, Progress(progress, REPORT_INTERVAL),
+                     metrics.Metrics(device, EPOCH_LOSS, ACCURACY, EPOCH_TIME, METRICS_PATH, resume=start_epoch > 0),
+                     should_stop)
+    finally:
+        if checkpointer is not None:
+            checkpointer.close()
+
+    # result
+    torch.save(net.state_dict(), MODEL_PATH)
+    print('训练完成')
+
+
+def train_epochs(net, optimizer, loss_func, dataloader, device, epochs, checkpointer, checkpoint_every, progress,
+                 epoch_metrics, should_stop=None):
+    # epochs 为 range(start_epoch, EPOCH)，进度中的 epoch 与不中断时相同
+    progress.emit('start', epochs=epochs.stop, start_epoch=epochs.start, batches=batch_count(dataloader))
+
+    for epoch in epochs:
         net.train()
 
-        for x_train, y_train in dataloader:
-            y_pred = net(x_train)
+        for batch, (x_train, y_train) in enumerate(profiler.iterate(dataloader)):
+            if should_stop is not None and should_stop():
+                raise Cancelled()
 
-            loss = loss_func(y_pred, y_train)
-            total_loss += loss.item()
+            with profiler.section('h2d'):
+                x_train, y_train = x_train.to(device), y_train.to(device)
+            with profiler.section('forward'):
+                y_pred = net(x_train)
 
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+            with profiler.section('loss'):
+                loss = loss_func(y_pred, y_train)
+                epoch_metrics.update(loss, y_pred, y_train)
 
-        toc = time.time()
-        print(f"epoch: {epoch}, loss: {total_loss}, time used: {toc - tic}")
+            with profiler.section('backward'):
+                optimizer.zero_grad()
+                loss.backward()
+            with profiler.section('optimizer'):
+                optimizer.step()
 
-    # result
-    torch.save(net.state_dict(), MODEL_PATH)
-    print('训练完成')
+            # 只在发送进度时同步一次 loss
+            if progress.due(len(x_train)):
+                progress.batch(epoch=epoch, batch=batch, loss=loss.item())
+
+        record = epoch_metrics.epoch(epoch)
+        print(', '.join(f'{k}: {v}' for k, v in record.items()))
+        progress.emit('epoch', **record)
+
+        if checkpointer is not None and ((epoch + 1) % checkpoint_every == 0 or epoch == epochs[-1]):
+            checkpointer.save(epoch, net, optimizer)
@@ -0,0 +1,163 @@
+import multiprocessing as mp
+import os
+import queue
+import sys
+import tempfile
+import traceback
+
+import torch
+import torch.distributed as dist
+
+import batching
+import checkpoint
+import metrics
+import tensor_store
+
+# CPU 多进程数据并行：hyperparameter 节点的 workers > 1 时使用
+# 计算图的数据只在主进程构建一次，放入共享内存，各进程按 rank 取自己的分片（batching.ShardedBatches）
+# 各进程用 gloo 后端，DistributedDataParallel 在 backward 中求各进程梯度的平均值
+# batch_size 为所有进程合计的大小，每个进程的 batch 为 batch_size // workers，学习率不需要修改
+# 每个进程的线程数为 cpu 数 // workers，并绑定到各自的 cpu 上，避免进程之间抢占
+# 进度、指标、检查点和模型只由 rank 0 写出
+
+
+class DistributedMetrics(metrics.Metrics):
+    # 每个 epoch 结束时合计所有进程的 loss 和正确数
+    def __init__(self, world, *args, **kwargs):
+        self.world = world
+        super().__init__(*args, **kwargs)
+
+    def epoch(self, epoch) -> dict:
+        dist.all_reduce(self.loss_sum)
+        dist.all_reduce(self.correct)
+        self.samples *= self.world
+        return super().epoch(epoch)
+
+
+def agreed_stop(stop_event):
+    # 所有进程必须在同一个 batch 停止，否则其余进程会在梯度同步时一直等待
+    def should_stop():
+        flag = torch.tensor([1 if stop_event.is_set() else 0])
+        dist.all_reduce(flag, op=dist.ReduceOp.MAX)
+        return bool(flag.item())
+    return should_stop
+
+
+def cpu_sets(workers):
+    # 把可用的 cpu 平均分给各进程
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = sorted(os.sched_getaffinity(0))
+    else:
+        cpus = list(range(os.cpu_count() or 1))
+    size = max(1, len(cpus) // workers)
+    return [cpus[rank * size:(rank + 1) * size] or cpus for rank in range(workers)]
+
+
+def _worker(rank, world, init_file, cpus, net, x, y, hyperparameters, optimizer_kwargs, loss_kwargs, events,
+            stop_event):
+    import model
+
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(len(cpus))
+    if rank != 0:
+        sys.stdout = open(os.devnull, 'w')
+
+    dist.init_process_group('gloo', init_method='file://' + init_file, rank=rank, world_size=world)
+    try:
+        kwargs = hyperparameters
+        model_path = kwargs['model_path']
+        device = torch.device('cpu')
+        model.set_seed(kwargs['seed'])
+
+        optimizer = model.call(optimizer_kwargs, params=net.parameters())
+        loss_func = model.call(loss_kwargs)
+        start_epoch = 0
+        if kwargs.get('resume', False):
+            # 每个进程读取同一个检查点，状态相同
+            start_epoch = checkpoint.resume(checkpoint.directory(model_path), net, optimizer)
+        ddp_net = torch.nn.parallel.DistributedDataParallel(net)
+
+        dataloader = batching.ShardedBatches((x, y), max(1, kwargs['batch_size'] // world), rank, world,
+                                             kwargs['shuffle'], kwargs['seed'], start_epoch)
+        metrics_path = kwargs.get('metrics_path') or (model_path + '.metrics.jsonl' if model_path else None)
+        epoch_metrics = DistributedMetrics(world, device, kwargs.get('epoch_loss', True), kwargs.get('accuracy', False),
+                                           kwargs.get('epoch_time', True), metrics_path if rank == 0 else None,
+                                           resume=start_epoch > 0)
+        progress = model.Progress(events.put if rank == 0 else None, kwargs.get('report_interval', 0.5))
+        checkpoint_every = kwargs.get('checkpoint_every', 0)
+        checkpointer = None
+        if rank == 0 and checkpoint_every:
+            checkpointer = checkpoint.Checkpointer(checkpoint.directory(model_path), kwargs.get('keep_last', 3))
+
+        try:
+            model.train_epochs(ddp_net, optimizer, loss_func, dataloader, device, range(start_epoch, kwargs['epoch']),
+                               checkpointer, checkpoint_every, progress, epoch_metrics, agreed_stop(stop_event))
+        finally:
+            if checkpointer is not None:
+                checkpointer.close()
+
+        if rank == 0:
+            torch.save(net.state_dict(), model_path)
+    except model.Cancelled:
+        pass
+    except Exception:
+        events.put({'event': 'worker_error', 'rank': rank, 'message': traceback.format_exc()})
+        raise
+    finally:
+        dist.destroy_process_group()
+
+
+def train(net, x, y, hyperparameters_model, optimizer_model, loss_model, workers, progress=None, should_stop=None):
+    import model
+
+    # 数据读入共享内存，子进程不复制；流式数据没有固定的样本数，不能分片
+    x, y = [tensor_store.read_rows(data, slice(None)) if tensor_store.is_mapped(data) else data for data in (x, y)]
+    if not isinstance(x, torch.Tensor) or not isinstance(y, torch.Tensor):
+        raise Exception('Data parallel mode needs tensor data.')
+    x = x.contiguous().share_memory_()
+    y = y.contiguous().share_memory_()
+
+    context = mp.get_context('spawn')
+    events = context.Queue()
+    stop_event = context.Event()
+    with tempfile.TemporaryDirectory() as directory:
+        init_file = os.path.join(directory, 'init')
+        processes = [
+            context.Process(target=_worker, daemon=True, args=(
+                rank, workers, init_file, cpus, net, x, y, hyperparameters_model['kwargs'],
+                optimizer_model['kwargs'], loss_model['kwargs'], events, stop_event))
+            for rank, cpus in enumerate(cpu_sets(workers))
+        ]
+        for process in processes:
+            process.start()
+
+        # 转发 rank 0 的进度事件，把取消请求传给各进程，直到所有进程结束
+        error = None
+        try:
+            while any(process.is_alive() for process in processes) or not events.empty():
+                if should_stop is not None and should_stop():
+                    stop_event.set()
+                try:
+                    event = events.get(timeout=0.1)
+                except queue.Empty:
+                    if error is None and any(process.exitcode not in (None, 0) for process in processes):
+                        error = 'Worker exited with code ' + str([process.exitcode for process in processes])
+                        break
+                    continue
+                if event['event'] == 'worker_error':
+                    error = f"Worker {event['rank']} failed:\n{event['message']}"
+                    break
+                if progress is not None:
+                    progress(event)
+        finally:
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+                process.join()
+
+    if error is not None:
+        raise Exception(error)
+    if stop_event.is_set():
+        raise model.Cancelled()
+    print('训练完成')
@@ -0,0 +1,147 @@
+import argparse
+import json
+import time
+
+import torch
+
+import stream
+import tensor_store
+
+# 时间序列的 preprocess 节点，输入为 N * C 的 tensor（行为时间，列为 PV），多个 in_items 先按列拼接
+# 输出的每一行对应所用历史中最后一个时刻，没有完整历史的开头几行被丢弃：
+#   window(size) / rolling_mean(size) / rolling_std(size) 丢弃 size - 1 行，lag(k) / diff(k) 丢弃 k 行
+# 目标值用 trim(start=丢弃的行数) 对齐
+# window / lag / trim 返回输入的视图，不复制数据（window 的输入不连续时先复制一次）；其余节点的输出与输入大小相同
+# rolling_mean / rolling_std 按块计算 float64 的累加和，一次遍历，每个窗口 O(1)，临时内存只有一块的大小
+
+
+def _input(in_items) -> torch.Tensor:
+    tensors = []
+    for item in in_items:
+        if isinstance(item, stream.Stream):
+            raise Exception('Time series nodes need tensor data.')
+        if tensor_store.is_mapped(item):
+            item = tensor_store.read_rows(item, slice(None))  # 读入内存，转换为 float32
+        tensors.append(item if item.dim() > 1 else item.unsqueeze(-1))
+    if len(tensors) == 1:
+        return tensors[0]
+    return torch.cat(tensors, dim=1)
+
+
+def window(in_items, size, step=1):
+    # 滑动窗口：第 i 行为 x[i*step : i*step+size, :] 按行展开，即按时间从早到晚，每个时刻内按列排列
+    # 相邻窗口在连续的输入上只差 step 行，输出是输入的跨步视图 (L, size * C)，不复制数据
+    x = _input(in_items)
+    if size > len(x):
+        raise Exception(f'Window size {size} is larger than the series ({len(x)} rows).')
+    x = x.contiguous()  # 已经连续时不复制
+    columns = x[0].numel()
+    rows = (len(x) - size) // step + 1
+    return x.as_strided((rows, size * columns), (step * columns, 1))
+
+
+def lag(in_items, periods=1):
+    # 第 t 行为 x[t - periods]；periods < 0 时为 x[t + |periods|]，丢弃末尾的行
+    x = _input(in_items)
+    if periods >= 0:
+        return x[:len(x) - periods]
+    return x[-periods:]
+
+
+def diff(in_items, periods=1):
+    # x[t] - x[t - periods]
+    x = _input(in_items)
+    return x[periods:] - x[:len(x) - periods]
+
+
+def trim(in_items, start=0, end=0):
+    # 丢弃开头 start 行和末尾 end 行，用于对齐目标值
+    x = _input(in_items)
+    return x[start:len(x) - end]
+
+
+def _rolling(x, size, std, block_rows):
+    # 每块取 block_rows 个输出行所需的输入，用 float64 累加和求窗口内的和与平方和
+    rows = len(x) - size + 1
+    if rows <= 0:
+        raise Exception(f'Window size {size} is larger than the series ({len(x)} rows).')
+    output = torch.empty((rows,) + tuple(x.shape[1:]), dtype=x.dtype, device=x.device)
+
+    for i in range(0, rows, block_rows):
+        j = min(i + block_rows, rows)
+        block = x[i:j + size - 1].double()
+        if std:
+            # 方差与平移无关，减去块的均值减少累加误差
+            block = block - block.mean(0)
+        zero = block.new_zeros((1,) + tuple(block.shape[1:]))
+        sums = torch.cat([zero, block.cumsum(0)])
+        window_sum = sums[size:] - sums[:-size]
+        if not std:
+            output[i:j] = window_sum / size
+            continue
+        squares = torch.cat([zero, (block * block).cumsum(0)])
+        window_squares = squares[size:] - squares[:-size]
+        variance = (window_squares - window_sum * window_sum / size) / max(size - 1, 1)
+        output[i:j] = variance.clamp_(min=0).sqrt_()
+    return output
+
+
+def rolling_mean(in_items, size, block_rows=1 << 20):
+    return _rolling(_input(in_items), size, False, block_rows)
+
+
+def rolling_std(in_items, size, block_rows=1 << 20):
+    # 与 torch.std 相同，除以 size - 1
+    return _rolling(_input(in_items), size, True, block_rows)
+
+
+def normalize(in_items, method='zscore', eps=1e-8):
+    # 按列归一化：zscore 为 (x - mean) / std，minmax 缩放到 [0, 1]
+    # 只分配一次与输入大小相同的输出，之后原地计算
+    x = _input(in_items)
+    if method == 'zscore':
+        std, mean = torch.std_mean(x, dim=0)
+        out = x - mean
+        return out.div_(std + eps)
+    elif method == 'minmax':
+        low, high = x.min(0).values, x.max(0).values
+        out = x - low
+        return out.div_(high - low + eps)
+    else:
+        raise Exception('Unknown normalize method: ' + method)
+
+
+def benchmark(rows=10_000_000, columns=1, size=64, seed=0):
+    # 每个节点的耗时和输出相对输入的大小
+    torch.manual_seed(seed)
+    x = torch.randn(rows, columns).cumsum(0)
+    input_bytes = x.element_size() * x.nelement()
+    nodes = {
+        'window': lambda: window([x], size),
+        'lag': lambda: lag([x], size),
+        'diff': lambda: diff([x]),
+        'trim': lambda: trim([x], size - 1),
+        'rolling_mean': lambda: rolling_mean([x], size),
+        'rolling_std': lambda: rolling_std([x], size),
+        'normalize': lambda: normalize([x]),
+    }
+
+    results = []
+    for name, f in nodes.items():
+        tic = time.perf_counter()
+        y = f()
+        seconds = time.perf_counter() - tic
+        view = y.untyped_storage().data_ptr() == x.untyped_storage().data_ptr()
+        results.append({'node': name, 'seconds': seconds, 'shape': list(y.shape), 'view': view,
+                        'new_bytes_per_input_byte': 0.0 if view else y.element_size() * y.nelement() / input_bytes})
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the time series preprocess nodes.')
+    parser.add_argument('--rows', type=int, default=10_000_000)
+    parser.add_argument('--columns', type=int, default=1)
+    parser.add_argument('--size', type=int, default=64)
+    args = parser.parse_args()
+
+    print(json.dumps(benchmark(args.rows, args.columns, args.size), indent=4))
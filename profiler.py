@@ -0,0 +1,124 @@
+import time
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+# 实验运行的分阶段 / 分层耗时统计，由 hyperparameter 节点的 profile 选项开启
+# 阶段：data / preprocess（每个计算图节点），build（每个模型节点的构建），
+#      fetch（取 batch）, h2d（拷贝到 device）, forward, loss, backward, optimizer，
+#      layer.forward / layer.backward（Sequential 或 dag.GraphModule 的每一层）
+# 开启时每个计时点都会同步 cuda，结果是准确的单步耗时，但训练会变慢
+# memory: cuda 上为 memory_allocated 的增量，cpu 上为输出 tensor 的字节数
+
+current = None  # 正在运行的 Profiler，None 表示未开启
+
+
+def _nbytes(x):
+    if isinstance(x, torch.Tensor):
+        return x.element_size() * x.nelement()
+    if isinstance(x, (list, tuple)):
+        return sum(_nbytes(i) for i in x)
+    return 0
+
+
+class Profiler:
+    def __init__(self, device):
+        self.device = device
+        self.cuda = device.type == 'cuda'
+        self.records = {}  # (stage, name) -> [calls, seconds, memory]
+        self.handles = []
+
+    def _now(self):
+        if self.cuda:
+            torch.cuda.synchronize(self.device)
+        return time.perf_counter()
+
+    def _memory(self):
+        return torch.cuda.memory_allocated(self.device) if self.cuda else 0
+
+    def add(self, stage, name, seconds, memory=0):
+        record = self.records.setdefault((stage, name), [0, 0.0, 0])
+        record[0] += 1
+        record[1] += seconds
+        record[2] += memory
+
+    @contextmanager
+    def section(self, stage, name=''):
+        # output: 调用者可以把输出放进 output['value']，cpu 上按输出大小统计内存
+        output = {}
+        memory, tic = self._memory(), self._now()
+        yield output
+        toc = self._now()
+        allocated = self._memory() - memory if self.cuda else _nbytes(output.get('value'))
+        self.add(stage, name, toc - tic, allocated)
+
+    def iterate(self, loader):
+        # 统计每次取 batch 的时间
+        iterator = iter(loader)
+        while True:
+            tic = self._now()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            self.add('fetch', '', time.perf_counter() - tic, _nbytes(batch))
+            yield batch
+
+    def hook_layers(self, net):
+        # 为网络的每一层注册前向和反向 hook
+        for name, layer in net.named_children():
+            label = f'{name}:{type(layer).__name__}'
+            state = {}
+
+            def forward_pre(module, inputs, state=state):
+                state['forward'] = (self._memory(), self._now())
+
+            def forward(module, inputs, outputs, state=state, label=label):
+                memory, tic = state.pop('forward')
+                allocated = self._memory() - memory if self.cuda else _nbytes(outputs)
+                self.add('layer.forward', label, self._now() - tic, allocated)
+
+            def backward_pre(module, grad_outputs, state=state):
+                state['backward'] = (self._memory(), self._now())
+
+            def backward(module, grad_inputs, grad_outputs, state=state, label=label):
+                memory, tic = state.pop('backward', (0, None))
+                if tic is not None:
+                    allocated = self._memory() - memory if self.cuda else _nbytes(grad_inputs)
+                    self.add('layer.backward', label, self._now() - tic, allocated)
+
+            self.handles += [layer.register_forward_pre_hook(forward_pre), layer.register_forward_hook(forward),
+                             layer.register_full_backward_pre_hook(backward_pre),
+                             layer.register_full_backward_hook(backward)]
+
+    def remove_hooks(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    def report(self) -> str:
+        # 按总耗时排序
+        total = sum(record[1] for (stage, _), record in self.records.items() if not stage.startswith('layer.')) or 1.0
+        lines = [f"{'stage':<16}{'name':<32}{'calls':>8}{'total ms':>12}{'mean ms':>12}{'%':>8}{'memory MB':>12}"]
+        for (stage, name), (calls, seconds, memory) in sorted(self.records.items(), key=lambda item: -item[1][1]):
+            lines.append(f'{stage:<16}{name[:31]:<32}{calls:>8}{seconds * 1e3:>12.3f}{seconds / calls * 1e3:>12.4f}'
+                         f'{seconds / total * 100:>8.1f}{memory / 2 ** 20:>12.3f}')
+        lines.append('% is relative to the total of all non-layer stages; layer stages are included in forward/backward.')
+        return '\n'.join(lines)
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            f.write(self.report() + '\n')
+
+
+def section(stage, name=''):
+    # 未开启时没有任何开销
+    if current is None:
+        return nullcontext({})
+    return current.section(stage, name)
+
+
+def iterate(loader):
+    if current is None:
+        return loader
+    return current.iterate(loader)
@@ -0,0 +1,28 @@
+import os
+
+# PV 访问的 backend：'epics' 为 pyepics，'sim' 为本地模拟 PV（sim_pv.SimServer）
+# 未指定时由环境变量 AIECS_PV_BACKEND 决定，默认 'epics'
+# 两者都是按需导入，CI 和开发机上不需要安装 pyepics
+
+_sim_server = None
+
+
+def get(backend=None):
+    if backend is None:
+        backend = os.environ.get('AIECS_PV_BACKEND', 'epics')
+
+    if backend == 'epics':
+        import epics
+        return epics
+
+    elif backend == 'sim':
+        global _sim_server
+        if _sim_server is None:
+            import sim_pv
+            _sim_server = sim_pv.SimServer()
+        return _sim_server
+
+    elif isinstance(backend, str):
+        raise Exception('Unknown PV backend: ' + backend)
+
+    return backend
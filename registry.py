@@ -0,0 +1,49 @@
+import importlib
+import json
+import os
+
+# 节点 func 的解析：只允许 modules.json 中登记过的函数
+# 'module.attr' 在第一次解析时才导入 module；不带模块名的在 model 模块中查找，如 cat, DL
+# 解析结果缓存，重复构建计算图（如超参数搜索）时不再解析
+
+MODULE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'modules.json')
+
+_registered = None
+_cache = {}
+
+
+def load(path=MODULE_PATH):
+    # 读取 modules.json 中所有节点的 func
+    global _registered
+    with open(path) as f:
+        modules = json.load(f)
+    _registered = {js['kwargs']['func'] for v in modules['modules'].values() for js in v}
+    _cache.clear()
+
+
+def register(name):
+    # 登记 modules.json 以外的函数，如 benchmark 生成的数据节点
+    if _registered is None:
+        load()
+    _registered.add(name)
+
+
+def registered():
+    if _registered is None:
+        load()
+    return set(_registered)
+
+
+def resolve(name):
+    if name in _cache:
+        return _cache[name]
+
+    if _registered is None:
+        load()
+    if name not in _registered:
+        raise Exception('Unregistered func: ' + name)
+
+    module_name, _, attr = name.rpartition('.')
+    f = getattr(importlib.import_module(module_name or 'model'), attr)
+    _cache[name] = f
+    return f
@@ -0,0 +1,67 @@
+import time
+
+START = time.perf_counter()
+
+import argparse
+import json
+import os
+import sys
+
+import runner
+import save_format
+
+# 命令行运行保存的实验，不需要 PySide2 和显示器
+# python run.py example/save.json [--progress] [--timing]
+# torch / sklearn / epics 等只在计算图的节点用到时才导入
+# --progress 时 stdout 只有 json 行的进度事件，训练过程中其余的输出（包括数据并行的子进程）改写到 stderr
+
+HEAVY_MODULES = ['torch', 'numpy', 'sklearn', 'epics', 'PySide2']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run a saved AIECS experiment without the editor.')
+    parser.add_argument('save_file', help='experiment json saved by the editor')
+    parser.add_argument('--progress', action='store_true',
+                        help='print progress events as json lines, other output goes to stderr')
+    parser.add_argument('--timing', action='store_true', help='print startup and run time as json to stderr')
+    parser.add_argument('--dry-run', action='store_true', help='only load the experiment, do not run it')
+    args = parser.parse_args(argv)
+
+    timing = {'startup': time.perf_counter() - START}
+
+    tic = time.perf_counter()
+    models = save_format.nest(save_format.load(args.save_file))
+    timing['load'] = time.perf_counter() - tic
+
+    if not args.dry_run:
+        tic = time.perf_counter()
+        if args.progress:
+            # 事件写到 stdout 的副本，文件描述符 1 指向 stderr，子进程继承
+            sys.stdout.flush()
+            stdout = os.dup(1)
+            events = os.fdopen(os.dup(1), 'w')
+            os.dup2(2, 1)
+
+            def progress(event):
+                print(json.dumps(event), file=events, flush=True)
+
+            try:
+                runner.run_models(models, progress=progress)
+            finally:
+                sys.stdout.flush()
+                os.dup2(stdout, 1)
+                os.close(stdout)
+                events.close()
+        else:
+            runner.run_models(models)
+        timing['run'] = time.perf_counter() - tic
+
+    timing['total'] = time.perf_counter() - START
+    timing['imported'] = [name for name in HEAVY_MODULES if name in sys.modules]
+    if args.timing:
+        print(json.dumps(timing), file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
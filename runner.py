@@ -0,0 +1,92 @@
+import multiprocessing as mp
+import os
+import queue
+import signal
+import sys
+import traceback
+
+import save_format
+
+# 在独立的进程中运行实验，训练不占用界面线程
+# 进度事件通过进程间队列发回，事件格式见 model.Progress：
+# start / batch / epoch，最后是 done / cancelled / error 之一
+
+
+def run_models(models, progress=None, should_stop=None, **kwargs):
+    # 找到唯一的 hyperparameter 节点，用它的 func 运行整个计算图；kwargs 传给 func，如 DL 的 prebuilt
+    import model
+
+    f = None
+    for node in models:
+        if node['dtype'] == 'hyperparameters':
+            if f is not None:
+                raise Exception('More than one hyperparameter model.')
+            f = model.resolve(node['kwargs']['func'])
+
+    if f is None:
+        raise Exception('No hyperparameter model.')
+
+    return f(models, progress=progress, should_stop=should_stop, **kwargs)
+
+
+def _worker(path, events, stop_event):
+    # 降低优先级并留出一个核，训练占满 CPU 时界面仍然能及时响应
+    if hasattr(os, 'nice'):
+        os.nice(5)
+    # kill() 时正常退出，数据并行的子进程随之结束
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+    import torch
+    torch.set_num_threads(max(1, (os.cpu_count() or 2) - 1))
+
+    import model
+    try:
+        models = save_format.nest(save_format.load(path))
+        run_models(models, progress=events.put, should_stop=stop_event.is_set)
+        events.put({'event': 'done'})
+    except model.Cancelled:
+        events.put({'event': 'cancelled'})
+    except Exception as e:
+        # 形状检查的错误带有 problems，编辑器据此标出节点
+        events.put({'event': 'error', 'message': traceback.format_exc(), 'problems': getattr(e, 'problems', [])})
+
+
+class Run:
+    # 一次后台运行：start() 启动进程，poll() 取出已收到的事件，cancel() 取消
+    def __init__(self, path):
+        context = mp.get_context('spawn')
+        self.events = context.Queue()
+        self.stop_event = context.Event()
+        # 数据并行模式会再启动子进程，daemon 进程不能有子进程；关闭界面时由 MainWindow 结束运行
+        self.process = context.Process(target=_worker, args=(path, self.events, self.stop_event))
+        self.finished = False
+
+    def start(self):
+        self.process.start()
+        return self
+
+    def poll(self):
+        # 先检查进程状态再取事件，进程退出前发出的事件不会被漏掉
+        alive = self.process.is_alive()
+        events = []
+        while True:
+            try:
+                event = self.events.get_nowait()
+            except queue.Empty:
+                break
+            events.append(event)
+            if event['event'] in ('done', 'cancelled', 'error'):
+                self.finished = True
+
+        if not self.finished and not alive:
+            # 进程异常退出，没有发出结束事件
+            self.finished = True
+            events.append({'event': 'error', 'message': 'Worker exited with code ' + str(self.process.exitcode)})
+        return events
+
+    def cancel(self):
+        # 请求在下一个 batch 前停止，不阻塞调用者
+        self.stop_event.set()
+
+    def kill(self):
+        # 数据加载等阶段无法及时响应 cancel 时强制结束
+        self.process.terminate()
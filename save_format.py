@@ -0,0 +1,59 @@
+import json
+
+from graph import GraphIndex, upstream_order
+
+# 保存文件格式
+# 0.1.0: models 为队尾节点列表，每个节点在 in_items 中嵌套保存所有上游节点，共享的节点会重复保存
+# 0.2.0: nodes 中每个节点只保存一次，带有稳定的 id；edges 为 [start_id, end_id] 列表，
+#        同一个 end 的边按 in_items 的顺序排列
+
+SAVE_VERSION = "0.2.0"
+
+
+def flatten(models):
+    # 嵌套的 0.1.0 models -> nodes, edges；0.1.0 中按名字识别同一个节点
+    # 按拓扑顺序编号，不递归，节点数多的计算图不会超出递归深度
+    order = upstream_order(models, lambda model: model['name'])
+    ids = {model['name']: node_id for node_id, model in enumerate(order)}
+    nodes = [{
+        'id': ids[model['name']],
+        'name': model['name'],
+        'dtype': model['dtype'],
+        'pos': model['pos'],
+        'kwargs': model['kwargs'],
+    } for model in order]
+    edges = [[ids[in_item['name']], ids[model['name']]] for model in order for in_item in model['in_items']]
+    return nodes, edges
+
+
+def upgrade(js):
+    # 把旧版本的保存文件转换为当前版本
+    if js['save_version'] == '0.1.0':
+        nodes, edges = flatten(js['models'])
+        js = {
+            'save_version': '0.2.0',
+            'module_version': js['module_version'],
+            'scene': js['scene'],
+            'nodes': nodes,
+            'edges': edges,
+        }
+
+    if js['save_version'] != SAVE_VERSION:
+        raise Exception('Unknown save version: ' + js['save_version'])
+    return js
+
+
+def load(path):
+    with open(path) as f:
+        return upgrade(json.load(f))
+
+
+def nest(js):
+    # 转换为 model.DL 使用的嵌套形式，返回队尾节点列表
+    # 共享的节点是同一个 dict 对象，不会复制，大小与节点数和边数成线性关系
+    graph = GraphIndex.from_edges([node['id'] for node in js['nodes']], js['edges'])
+    models = {node['id']: dict(node, in_items=[]) for node in js['nodes']}
+    for start, end, _ in graph.edges():
+        models[end]['in_items'].append(models[start])
+
+    return [models[node_id] for node_id in graph.nodes if node_id in graph.sinks]
@@ -0,0 +1,212 @@
+import argparse
+import json
+import math
+import os
+import random
+import tempfile
+import threading
+import time
+
+
+class SimPV:
+    # 与 epics.PV 接口一致的模拟 PV
+    def __init__(self, server, pvname, callback=None, auto_monitor=None, **kwargs):
+        self.server = server
+        self.pvname = pvname
+        self.auto_monitor = auto_monitor
+        self.callbacks = []
+        self.connected = True
+        server.connect(pvname)
+        if callback is not None:
+            self.add_callback(callback)
+
+    @property
+    def value(self):
+        return self.server.values[self.pvname]
+
+    @property
+    def timestamp(self):
+        return self.server.timestamps[self.pvname]
+
+    def get(self, timeout=None, use_monitor=True, **kwargs):
+        if not (use_monitor and self.auto_monitor):
+            self.server.round_trip()
+        return self.value
+
+    def put(self, value, wait=False, **kwargs):
+        self.server.round_trip()
+        self.server.set(self.pvname, value)
+        return 1
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+        if self.auto_monitor is not False:
+            self.server.subscribe(self)
+
+    def clear_callbacks(self):
+        self.callbacks = []
+        self.server.unsubscribe(self)
+
+    def wait_for_connection(self, timeout=None):
+        return True
+
+    def disconnect(self):
+        self.clear_callbacks()
+        self.connected = False
+
+    def notify(self, value, timestamp):
+        for callback in self.callbacks:
+            callback(pvname=self.pvname, value=value, timestamp=timestamp)
+
+
+class SimServer:
+    # 本地模拟 PV 源，提供 PV / caget / caget_many / caput / caput_many，可作为 epics 的替代 backend
+    # n_pvs: 预先创建 '<prefix>PV<i>'，其他名字在第一次访问时创建
+    # rate: 每个 PV 每秒更新次数，更新时通知所有 monitor
+    # noise: 正弦信号上叠加的高斯噪声标准差
+    # latency: 每次网络往返的延迟（秒），批量读写只算一次
+    def __init__(self, n_pvs=100, rate=10.0, noise=0.01, latency=0.0, prefix='SIM:', seed=0):
+        self.rate = rate
+        self.noise = noise
+        self.latency = latency
+        self.pvnames = [prefix + 'PV' + str(i) for i in range(n_pvs)]
+
+        self.values = {}
+        self.timestamps = {}
+        self.phases = {}
+        self.monitors = {}  # pvname -> [SimPV]
+        self.updates = 0
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        for pvname in self.pvnames:
+            self.connect(pvname)
+
+    def connect(self, pvname):
+        with self._lock:
+            if pvname not in self.values:
+                self.phases[pvname] = self._random.uniform(0, 2 * math.pi)
+                self.values[pvname] = math.sin(self.phases[pvname])
+                self.timestamps[pvname] = time.time()
+
+    def round_trip(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def subscribe(self, pv):
+        with self._lock:
+            monitors = self.monitors.setdefault(pv.pvname, [])
+            if pv not in monitors:
+                monitors.append(pv)
+        if self.rate and self._thread is None:
+            self.start()
+
+    def unsubscribe(self, pv):
+        with self._lock:
+            if pv in self.monitors.get(pv.pvname, []):
+                self.monitors[pv.pvname].remove(pv)
+
+    def set(self, pvname, value):
+        self.connect(pvname)
+        timestamp = time.time()
+        with self._lock:
+            self.values[pvname] = value
+            self.timestamps[pvname] = timestamp
+            monitors = list(self.monitors.get(pvname, []))
+        for pv in monitors:
+            pv.notify(value, timestamp)
+
+    def step(self):
+        # 所有有 monitor 的 PV 更新一次
+        timestamp = time.time()
+        with self._lock:
+            pvnames = [pvname for pvname, monitors in self.monitors.items() if monitors]
+        for pvname in pvnames:
+            value = math.sin(timestamp + self.phases[pvname]) + self._random.gauss(0.0, self.noise)
+            self.set(pvname, value)
+        self.updates += len(pvnames)
+
+    def _loop(self):
+        start = time.monotonic()
+        k = 0
+        while not self._stop_event.is_set():
+            self.step()
+            k += 1
+            self._stop_event.wait(max(start + k / self.rate - time.monotonic(), 0.0))
+
+    def start(self):
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def PV(self, pvname, callback=None, auto_monitor=None, **kwargs):
+        return SimPV(self, pvname, callback=callback, auto_monitor=auto_monitor, **kwargs)
+
+    def caget(self, pvname, timeout=None, **kwargs):
+        self.round_trip()
+        self.connect(pvname)
+        return self.values[pvname]
+
+    def caget_many(self, pvnames, timeout=None, **kwargs):
+        self.round_trip()
+        for pvname in pvnames:
+            self.connect(pvname)
+        return [self.values[pvname] for pvname in pvnames]
+
+    def caput(self, pvname, value, wait=False, **kwargs):
+        self.round_trip()
+        self.set(pvname, value)
+        return 1
+
+    def caput_many(self, pvnames, values, wait=False, **kwargs):
+        self.round_trip()
+        for pvname, value in zip(pvnames, values):
+            self.set(pvname, value)
+        return [1] * len(pvnames)
+
+
+def benchmark(n_pvs, rate, noise, latency, period, duration, seed=0):
+    # 在模拟 PV 上测试 save_by_change 吞吐、save_by_time 抖动和 save_all 快照耗时
+    import epics_save
+
+    results = {'n_pvs': n_pvs, 'rate': rate, 'noise': noise, 'latency': latency, 'period': period,
+               'duration': duration}
+    with tempfile.TemporaryDirectory() as path:
+        server = SimServer(n_pvs, rate, noise, latency, seed=seed)
+        results['save_by_change'] = epics_save.save_by_change(
+            server.pvnames, os.path.join(path, 'change'), duration, backend=server)
+        server.stop()
+
+        server = SimServer(n_pvs, 0, noise, latency, seed=seed)
+        results['save_by_time'] = epics_save.save_by_time(
+            server.pvnames, os.path.join(path, 'time'), period, duration, backend=server)
+
+        pool = epics_save.ConnectionPool(backend=server)
+        epics_save.save_all(server.pvnames, os.path.join(path, 'cold.csv'), connection_pool=pool)
+        results['save_all'] = epics_save.save_all(server.pvnames, os.path.join(path, 'warm.csv'), connection_pool=pool)
+        pool.close()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark archiver and sampler on simulated PVs.')
+    parser.add_argument('--pvs', type=int, default=100)
+    parser.add_argument('--rate', type=float, default=1000.0, help='monitor updates per PV per second')
+    parser.add_argument('--noise', type=float, default=0.01)
+    parser.add_argument('--latency', type=float, default=0.001, help='seconds per round trip')
+    parser.add_argument('--period', type=float, default=0.01, help='save_by_time sampling period')
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    print(json.dumps(benchmark(args.pvs, args.rate, args.noise, args.latency, args.period, args.duration,
+                               args.seed), indent=4))
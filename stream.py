@@ -0,0 +1,242 @@
+import itertools
+import queue
+import threading
+import time
+
+import torch
+from torch.utils.data import IterableDataset
+
+import pv_backend
+import tensor_store
+
+
+class Stream:
+    # 可重复迭代的数据流，每次迭代产生若干 [n, k] 的数据块
+    # factory() 返回一个新的迭代器，所以每个 epoch 都可以重新读取
+    # live=True 为实时数据：每个 epoch 接着上一个 epoch 读取，epoch 结束时已读出但没有用到的行
+    # 通过 unread 放回，下一次迭代最先取出，否则各流丢弃的行数不同，之后的行就不再对齐
+    def __init__(self, factory, live=False):
+        self.factory = factory
+        self.live = live
+        self.leftover = []  # 放回的数据块，后放回的先取出
+
+    def __iter__(self):
+        while self.leftover:
+            yield self.leftover.pop()
+        yield from self.factory()
+
+    def unread(self, chunk):
+        # 非实时数据每个 epoch 从头读取，不需要放回
+        if self.live and len(chunk):
+            self.leftover.append(chunk)
+
+
+def from_tensor(tensor, chunk_rows=4096):
+    def chunks():
+        for i in range(0, len(tensor), chunk_rows):
+            yield tensor[i:i + chunk_rows]
+    return Stream(chunks)
+
+
+def _as_stream(x):
+    return x if isinstance(x, Stream) else from_tensor(x)
+
+
+def aligned(streams):
+    # 逐块对齐多个流：每次取各流当前都有的行数，块大小不同的流也能按行对齐
+    # 提前结束时（关闭生成器）各流已读出但没有产出的行放回各自的流
+    iterators = [iter(s) for s in streams]
+    pending = [None] * len(iterators)
+    try:
+        while True:
+            for i, iterator in enumerate(iterators):
+                while pending[i] is None or len(pending[i]) == 0:
+                    chunk = next(iterator, None)
+                    if chunk is None:
+                        return
+                    pending[i] = chunk
+
+            n = min(len(p) for p in pending)
+            rows = [p[:n] for p in pending]
+            pending = [p[n:] for p in pending]
+            yield rows
+    finally:
+        # 先关闭上游（如 cat 的流），它们的剩余数据在这里的剩余数据之后
+        for iterator in iterators:
+            iterator.close()
+        for s, p in zip(streams, pending):
+            if p is not None:
+                s.unread(p)
+
+
+def cat(tensors, dim=1):
+    streams = [_as_stream(t) for t in tensors]
+    return Stream(lambda: (torch.cat(chunks, dim=dim) for chunks in aligned(streams)),
+                  live=any(s.live for s in streams))
+
+
+def batches(x, y, batch_size):
+    # 把对齐后的 (x, y) 数据块重新切成 batch_size 行
+    # 提前结束时缓冲区中还没有产出的行放回 x 和 y 的流
+    x, y = _as_stream(x), _as_stream(y)
+    chunks = aligned([x, y])
+    buffer_x, buffer_y, rows = [], [], 0
+    try:
+        for chunk_x, chunk_y in chunks:
+            buffer_x.append(chunk_x)
+            buffer_y.append(chunk_y)
+            rows += len(chunk_x)
+            if rows < batch_size:
+                continue
+
+            all_x, all_y = torch.cat(buffer_x), torch.cat(buffer_y)
+            while rows >= batch_size:
+                batch = all_x[:batch_size], all_y[:batch_size]
+                all_x, all_y = all_x[batch_size:], all_y[batch_size:]
+                buffer_x, buffer_y, rows = [all_x], [all_y], rows - batch_size
+                yield batch
+
+        if rows:
+            rows = 0
+            yield torch.cat(buffer_x), torch.cat(buffer_y)
+    finally:
+        chunks.close()
+        if rows:
+            x.unread(torch.cat(buffer_x))
+            y.unread(torch.cat(buffer_y))
+
+
+class StreamDataset(IterableDataset):
+    # 流式训练数据：后台线程读取数据并切好 batch，放进有界队列
+    # 第一个 batch 准备好就可以开始训练，内存占用只取决于 prefetch 个 batch
+    def __init__(self, x, y, batch_size, prefetch=4, steps=None):
+        self.x = x
+        self.y = y
+        self.batch_size = batch_size
+        self.prefetch = prefetch
+        self.steps = steps  # 每个 epoch 的 batch 数，None 表示读完整个流
+        self._producer = None  # 上一个 epoch 的 (线程, stop_event)
+
+    def __iter__(self):
+        # 先等上一个 epoch 的后台线程退出并放回剩余的行，两个线程不能同时读取实时数据
+        if self._producer is not None:
+            thread, stop_event = self._producer
+            stop_event.set()
+            thread.join()
+
+        done = object()
+        batch_queue = queue.Queue(maxsize=self.prefetch)
+        stop_event = threading.Event()
+
+        def put(item):
+            while not stop_event.is_set():
+                try:
+                    batch_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            batch_iter = batches(self.x, self.y, self.batch_size)
+            try:
+                for batch in itertools.islice(batch_iter, self.steps):
+                    if not put(batch):
+                        return
+                put(done)
+            except Exception as e:
+                put(e)
+            finally:
+                batch_iter.close()
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        self._producer = thread, stop_event
+        try:
+            while True:
+                item = batch_queue.get()
+                if item is done:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # 不等待后台线程：实时数据源可能正阻塞在读取上，下一次 put 失败时线程自行退出，
+            # 下一个 epoch 开始时再等待它
+            stop_event.set()
+
+
+def store_column(path, column, chunk_rows=65536):
+    # 按块顺序读取列式 store 的一列；每个 epoch 重新打开，能读到归档新追加的数据
+    def chunks():
+        tensor = tensor_store.TensorStore(path, create=False).tensor(column)
+        for i in range(0, len(tensor), chunk_rows):
+            yield tensor[i:i + chunk_rows].float()
+    return Stream(chunks)
+
+
+class LiveFeed:
+    # 实时 PV 数据源：所有订阅的 PV 共用一个采样时钟，每个周期一次 caget_many
+    # 每个 PV 一个有界队列；任何一个队列满了就丢弃整行，保证各 PV 的样本仍然按行对齐
+    def __init__(self, period, backend=None, maxsize=65536):
+        self.period = period
+        self.backend = pv_backend.get(backend)
+        self.maxsize = maxsize
+        self.queues = {}
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def subscribe(self, pvname):
+        with self._lock:
+            if pvname not in self.queues:
+                self.queues[pvname] = queue.Queue(maxsize=self.maxsize)
+            return self.queues[pvname]
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, daemon=True)
+                self._thread.start()
+
+    def _loop(self):
+        start = time.monotonic()
+        k = 0
+        while True:
+            with self._lock:
+                items = list(self.queues.items())
+            pvnames = [pvname for pvname, _ in items]
+            values = self.backend.caget_many(pvnames, timeout=self.period)
+
+            if any(q.full() for _, q in items) or any(value is None for value in values):
+                self.dropped += 1
+            else:
+                for (_, q), value in zip(items, values):
+                    q.put(float(value))
+
+            k = max(k + 1, int((time.monotonic() - start) / self.period))
+            time.sleep(max(start + k * self.period - time.monotonic(), 0.0))
+
+
+_feeds = {}
+
+
+def pv(pvname, period=0.1, chunk_rows=64, backend=None):
+    # 实时 PV 流，永不结束；训练时用 steps 限制每个 epoch 的 batch 数
+    key = (period, backend)
+    if key not in _feeds:
+        _feeds[key] = LiveFeed(period, backend)
+    feed = _feeds[key]
+    samples = feed.subscribe(pvname)
+
+    def chunks():
+        feed.start()
+        while True:
+            chunk = [samples.get()]
+            while len(chunk) < chunk_rows:
+                try:
+                    chunk.append(samples.get_nowait())
+                except queue.Empty:
+                    break
+            yield torch.tensor(chunk, dtype=torch.float32).unsqueeze(-1)
+    return Stream(chunks, live=True)
@@ -0,0 +1,248 @@
+import argparse
+import concurrent.futures
+import contextlib
+import copy
+import csv
+import itertools
+import json
+import math
+import multiprocessing as mp
+import os
+import random
+import shutil
+import time
+import traceback
+
+import graph
+import runner
+import save_format
+
+# 超参数搜索：对保存的实验按搜索空间修改节点的 kwargs，在进程池中同时运行多次训练
+# python sweep.py example/save.json space.json --out sweep [--workers 4] [--eta 3] [--min-epochs 1]
+#
+# 搜索空间 space.json：
+# {"method": "grid", "params": {"SGD.lr": [0.1, 0.01], "DL.batch_size": [32, 128]}}
+# {"method": "random", "trials": 20, "seed": 0,
+#  "params": {"SGD.lr": {"low": 1e-4, "high": 0.1, "log": true}, "3.out_features": {"low": 8, "high": 64, "int": true}}}
+# 参数为 "<节点>.<kwarg>"，节点为节点名字或 id，名字重复时用 id；grid 只能用列表
+# 多个 kwarg 取同一个值时用逗号分隔，如层宽 "l1.out_features,l2.in_features"
+#
+# 不受搜索参数影响的数据节点只在主进程构建一次，放入共享内存，各次训练直接使用（DL 的 prebuilt）
+# successive halving：所有训练先运行 min_epochs 个 epoch，按最后一个 epoch 的 loss 保留前 1/eta，
+# 保留的训练从检查点继续运行到 min_epochs * eta 个 epoch，依次类推，直到 hyperparameter 节点的 epoch
+# min_epochs 为 0 时不提前停止，每次训练都运行完整的 epoch
+# 每次训练的模型、检查点、指标和输出在 <out>/trial-<n> 中，结果表为 <out>/results.csv
+
+_prebuilt = None
+
+
+def configurations(space):
+    params = space['params']
+    method = space.get('method', 'grid')
+    if method == 'grid':
+        for values in itertools.product(*params.values()):
+            yield dict(zip(params.keys(), values))
+    elif method == 'random':
+        rng = random.Random(space.get('seed', 0))
+        for _ in range(space['trials']):
+            yield {key: sample(spec, rng) for key, spec in params.items()}
+    else:
+        raise Exception('Unknown search method: ' + method)
+
+
+def sample(spec, rng):
+    if isinstance(spec, list):
+        return rng.choice(spec)
+    low, high = spec['low'], spec['high']
+    if spec.get('log', False):
+        value = math.exp(rng.uniform(math.log(low), math.log(high)))
+    else:
+        value = rng.uniform(low, high)
+    return int(round(value)) if spec.get('int', False) else value
+
+
+def find_node(js, name):
+    # 节点名字或 id
+    nodes = [node for node in js['nodes'] if str(node['id']) == name] or \
+            [node for node in js['nodes'] if node['name'] == name]
+    if len(nodes) != 1:
+        raise Exception(f'{len(nodes)} nodes match {name}, use the node id.')
+    return nodes[0]
+
+
+def targets(js, key):
+    # (节点, kwarg) 列表
+    result = []
+    for target in key.split(','):
+        name, _, kwarg = target.strip().rpartition('.')
+        node = find_node(js, name)
+        if kwarg not in node['kwargs']:
+            raise Exception(f'Node {name} has no kwarg {kwarg}.')
+        result.append((node, kwarg))
+    return result
+
+
+def apply(js, params):
+    # 返回修改了 kwargs 的副本
+    js = copy.deepcopy(js)
+    for key, value in params.items():
+        for node, kwarg in targets(js, key):
+            node['kwargs'][kwarg] = value
+    return js
+
+
+def hyperparameters_node(js):
+    return [node for node in js['nodes'] if node['dtype'] == 'hyperparameters'][0]
+
+
+def prebuild(js, swept):
+    # 构建 y 和网络的输入，跳过上游有搜索参数的节点
+    import torch
+    import model
+    import tensor_store
+
+    models = save_format.nest(js)
+    loss_model = [node for node in models if node['dtype'] == 'optimizer'][0]['in_items'][0]
+    roots = []
+    for in_item in loss_model['in_items']:
+        roots += model.net_inputs(in_item) if model.in_net(in_item) else [in_item]
+
+    # 按拓扑顺序标记上游有搜索参数的节点
+    depends = {}
+    for node in graph.upstream_order(roots, model.node_key):
+        depends[node['id']] = node['id'] in swept or any(depends[in_item['id']] for in_item in node['in_items'])
+
+    roots = [root for root in roots if not depends[root['id']]]
+    cache = model.NodeCache(roots)
+    prebuilt = {}
+    for root in roots:
+        value = model.build_data(root, cache)
+        # 流式数据不能共享，内存映射的数据各进程直接读取文件
+        if isinstance(value, torch.Tensor) and not tensor_store.is_mapped(value):
+            prebuilt[root['id']] = value.share_memory_()
+    return prebuilt
+
+
+def _init(prebuilt, threads):
+    global _prebuilt
+    import torch
+    torch.set_num_threads(threads)
+    _prebuilt = prebuilt
+
+
+def _run_trial(js, directory):
+    # 在进程池中运行一次训练到 hyperparameter 节点的 epoch，返回最后一个 epoch 的 loss
+    tic = time.time()
+    with open(os.path.join(directory, 'log.txt'), 'a') as log, contextlib.redirect_stdout(log):
+        runner.run_models(save_format.nest(js), prebuilt=_prebuilt)
+    with open(os.path.join(directory, 'model.pt.metrics.jsonl')) as f:
+        records = [json.loads(line) for line in f]
+    return records[-1]['loss'], time.time() - tic
+
+
+def rungs(epochs, min_epochs, eta):
+    if not min_epochs:
+        return [epochs]
+    result = []
+    while min_epochs < epochs:
+        result.append(min_epochs)
+        min_epochs *= eta
+    return result + [epochs]
+
+
+def sweep(path, space, out, workers=None, eta=3, min_epochs=1):
+    import torch.multiprocessing  # 注册 tensor 的共享内存序列化
+
+    js = save_format.load(path)
+    configs = list(configurations(space))
+    swept = {node['id'] for key in space['params'] for node, _ in targets(js, key)}
+    workers = workers or min(os.cpu_count() or 1, len(configs))
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    schedule = rungs(hyperparameters_node(js)['kwargs']['epoch'], min_epochs, eta)
+
+    os.makedirs(out, exist_ok=True)
+    trials = []
+    for i, params in enumerate(configs):
+        directory = os.path.join(out, f'trial-{i:04d}')
+        # 清除上一次搜索留下的检查点，否则会从它们继续
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+        trials.append({'trial': i, 'status': 'running', 'epochs': 0, 'loss': None, 'time': 0.0, 'error': '',
+                       'params': params, 'directory': directory, 'js': apply(js, params)})
+
+    tic = time.time()
+    prebuilt = prebuild(js, swept)
+    print(f'{len(trials)} trials, {workers} workers, rungs: {schedule}, '
+          f'prebuilt {len(prebuilt)} inputs in {time.time() - tic:.3f}s')
+
+    context = mp.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(workers, mp_context=context, initializer=_init,
+                                                initargs=(prebuilt, threads)) as pool:
+        for rung in schedule:
+            futures = {}
+            for trial in trials:
+                if trial['status'] != 'running':
+                    continue
+                # 每一级从上一级的检查点继续
+                kwargs = hyperparameters_node(trial['js'])['kwargs']
+                kwargs.update(epoch=rung, model_path=os.path.join(trial['directory'], 'model.pt'), metrics_path='',
+                              epoch_loss=True, checkpoint_every=rung, keep_last=1, resume=True, workers=0,
+                              profile=False)
+                futures[pool.submit(_run_trial, trial['js'], trial['directory'])] = trial
+
+            for future in concurrent.futures.as_completed(futures):
+                trial = futures[future]
+                try:
+                    loss, seconds = future.result()
+                except Exception:
+                    trial.update(status='error', error=traceback.format_exc().splitlines()[-1])
+                    continue
+                trial.update(epochs=rung, loss=loss, time=trial['time'] + seconds)
+
+            running = sorted((trial for trial in trials if trial['status'] == 'running'), key=loss_key)
+            print(f'rung {rung} epochs: ' + ', '.join(f"trial {trial['trial']} loss {trial['loss']:.6g}"
+                                                      for trial in running))
+            if rung != schedule[-1]:
+                for trial in running[max(1, len(running) // eta):]:
+                    trial['status'] = 'stopped'
+
+    for trial in trials:
+        if trial['status'] == 'running':
+            trial['status'] = 'completed'
+    trials.sort(key=loss_key)
+    write_results(trials, os.path.join(out, 'results.csv'))
+    return trials
+
+
+def loss_key(trial):
+    # 没有结果和 nan 排在最后
+    loss = trial['loss']
+    return math.inf if loss is None or math.isnan(loss) else loss
+
+
+def write_results(trials, path):
+    keys = list(trials[0]['params']) if trials else []
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['trial', 'status', 'epochs', 'loss', 'time'] + keys + ['error'])
+        for trial in trials:
+            writer.writerow([trial['trial'], trial['status'], trial['epochs'], trial['loss'], round(trial['time'], 3)]
+                            + [trial['params'][key] for key in keys] + [trial['error']])
+    print('Results saved in', path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Hyperparameter sweep over a saved AIECS experiment.')
+    parser.add_argument('save_file', help='experiment json saved by the editor')
+    parser.add_argument('space_file', help='search space json')
+    parser.add_argument('--out', default='sweep', help='directory for trials and results.csv')
+    parser.add_argument('--workers', type=int, default=None, help='processes, default: number of cpus')
+    parser.add_argument('--eta', type=int, default=3, help='keep the best 1/eta trials at each rung')
+    parser.add_argument('--min-epochs', type=int, default=1, help='epochs of the first rung, 0 disables early stop')
+    args = parser.parse_args()
+
+    with open(args.space_file) as f:
+        space = json.load(f)
+    results = sweep(args.save_file, space, args.out, args.workers, args.eta, args.min_epochs)
+    for trial in results:
+        print(trial['trial'], trial['status'], trial['epochs'], trial['loss'], trial['params'])
@@ -0,0 +1,202 @@
+import json
+import os
+import re
+import weakref
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+# 磁盘上的列式数据：一个目录，每列一个原始二进制文件，加一个 manifest.json
+# manifest: {"version": "0.1.0", "columns": {name: {"file": "xxx.bin", "dtype": "float32"}}}
+# 每列的行数由文件大小决定，所以列文件可以只追加写入
+# 定长记录表 tables: {name: {"file": "xxx.bin", "fields": [[field, dtype], ...]}}
+# 表的每个字段以 '<table>.<field>' 作为一列出现在 columns 中，读取时是记录文件上的跨步视图
+
+VERSION = "0.1.0"
+MANIFEST = 'manifest.json'
+
+# 由内存映射文件支持的 tensor / MappedTable，id -> weakref
+# tensor 的 == 是逐元素比较，不能直接放进 WeakSet
+_mapped = {}
+
+
+def _mark_mapped(x):
+    key = id(x)
+    _mapped[key] = weakref.ref(x, lambda _: _mapped.pop(key, None))
+
+
+def is_mapped(x) -> bool:
+    ref = _mapped.get(id(x))
+    return ref is not None and ref() is x
+
+
+def _file_name(name):
+    # PV 名包含 ':' 等字符，文件名只保留安全字符
+    return re.sub(r'[^0-9A-Za-z_.-]', '_', name) + '.bin'
+
+
+class TensorStore:
+    def __init__(self, path, create=True):
+        self.path = path
+        manifest_path = os.path.join(path, MANIFEST)
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                self.manifest = json.load(f)
+            if self.manifest['version'] != VERSION:
+                print('Warning! Different tensor store version.')
+        elif not create:
+            raise FileNotFoundError('No tensor store in ' + path)
+        else:
+            os.makedirs(path, exist_ok=True)
+            self.manifest = {'version': VERSION, 'columns': {}}
+            self.save_manifest()
+
+    @property
+    def columns(self):
+        return list(self.manifest['columns'])
+
+    def save_manifest(self):
+        # 先写临时文件再替换，读者不会看到写了一半的 manifest
+        tmp = os.path.join(self.path, MANIFEST + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp, os.path.join(self.path, MANIFEST))
+
+    def add_column(self, name, dtype='float32'):
+        if name not in self.manifest['columns']:
+            files = {v['file'] for v in self.manifest['columns'].values()}
+            file_name = _file_name(name)
+            while file_name in files:
+                file_name = '_' + file_name
+            self.manifest['columns'][name] = {'file': file_name, 'dtype': np.dtype(dtype).name}
+            self.save_manifest()
+        return self.manifest['columns'][name]
+
+    def add_table(self, name, fields):
+        # fields: [(field, dtype), ...]
+        if name not in self.manifest.setdefault('tables', {}):
+            table = {'file': _file_name(name + '.records'),
+                     'fields': [[field, np.dtype(dtype).name] for field, dtype in fields]}
+            self.manifest['tables'][name] = table
+            for field, dtype in table['fields']:
+                self.manifest['columns'][name + '.' + field] = {'file': table['file'], 'dtype': dtype, 'table': name}
+            self.save_manifest()
+        return self.record_dtype(name)
+
+    def record_dtype(self, table) -> np.dtype:
+        return np.dtype([(field, dtype) for field, dtype in self.manifest['tables'][table]['fields']])
+
+    def append_records(self, table, records: np.ndarray):
+        dtype = self.record_dtype(table)
+        with open(os.path.join(self.path, self.manifest['tables'][table]['file']), 'ab') as f:
+            # 上次写入中途崩溃留下的不完整记录先截掉，否则之后的记录都会错位
+            size = f.seek(0, os.SEEK_END)
+            if size % dtype.itemsize:
+                f.truncate(size - size % dtype.itemsize)
+            f.write(np.ascontiguousarray(records, dtype=dtype).tobytes())
+
+    def column_path(self, name):
+        return os.path.join(self.path, self.manifest['columns'][name]['file'])
+
+    def _row_dtype(self, name) -> np.dtype:
+        column = self.manifest['columns'][name]
+        if 'table' in column:
+            return self.record_dtype(column['table'])
+        return np.dtype(column['dtype'])
+
+    def rows(self, name):
+        path = self.column_path(name)
+        return os.path.getsize(path) // self._row_dtype(name).itemsize if os.path.exists(path) else 0
+
+    def append(self, columns: dict):
+        # columns: {name: 1维数组}，追加到各列文件末尾
+        for name, values in columns.items():
+            if name not in self.manifest['columns']:
+                self.add_column(name, np.asarray(values).dtype)
+            dtype = self.manifest['columns'][name]['dtype']
+            with open(self.column_path(name), 'ab') as f:
+                f.write(np.ascontiguousarray(values, dtype=dtype).tobytes())
+
+    def array(self, name) -> np.ndarray:
+        # copy-on-write 映射：只读取被访问的页，对返回数组的写入不会写回文件
+        column = self.manifest['columns'][name]
+        rows = self.rows(name)
+        if rows == 0:
+            return np.empty(0, dtype=column['dtype'])
+        array = np.memmap(self.column_path(name), dtype=self._row_dtype(name), mode='c', shape=(rows,))
+        if 'table' in column:
+            array = array[name[len(column['table']) + 1:]]
+        return array
+
+    def tensor(self, name) -> torch.Tensor:
+        # 零拷贝 N * 1 tensor
+        tensor = torch.from_numpy(self.array(name)).unsqueeze(-1)
+        _mark_mapped(tensor)
+        return tensor
+
+
+def write(path, columns: dict) -> TensorStore:
+    # 新建或覆盖 store
+    store = TensorStore(path)
+    for name in columns:
+        if name in store.manifest['columns'] and os.path.exists(store.column_path(name)):
+            os.remove(store.column_path(name))
+    store.append(columns)
+    return store
+
+
+def read_rows(data, index):
+    # 从内存映射的 tensor / MappedTable 取出行，读入内存并转换为 float32
+    # store 中的列可以是 float64 等类型，只转换取出的行，不会读入整列
+    if is_mapped(data):
+        return data[index].float()
+    return data[index]
+
+
+class MappedTable(Dataset):
+    # 内存映射列在 dim=1 上的惰性拼接，只在取样本时读取并拼接对应的行
+    def __init__(self, tensors):
+        self.tensors = []
+        for tensor in tensors:
+            if isinstance(tensor, MappedTable):
+                self.tensors.extend(tensor.tensors)
+            else:
+                self.tensors.append(tensor if tensor.dim() > 1 else tensor.unsqueeze(-1))
+
+        rows = {len(tensor) for tensor in self.tensors}
+        if len(rows) != 1:
+            raise Exception('Sizes of tensors must match: ' + str(sorted(rows)))
+        _mark_mapped(self)
+
+    def __len__(self):
+        return len(self.tensors[0])
+
+    def __getitem__(self, index):
+        return torch.cat([tensor[index].float() for tensor in self.tensors], dim=-1)
+
+    def size(self, dim=None):
+        size = torch.Size([len(self), sum(tensor.size(1) for tensor in self.tensors)])
+        return size if dim is None else size[dim]
+
+    @property
+    def shape(self):
+        return self.size()
+
+
+class MappedDataset(Dataset):
+    # 数据留在磁盘映射中，DataLoader 每次只读取一个batch的行
+    def __init__(self, x, y):
+        if len(x) != len(y):
+            raise Exception('Size mismatch between x and y.')
+        self.x = x
+        self.y = y
+
+    def __len__(self):
+        return len(self.x)
+
+    def __getitem__(self, index):
+        # index 为一个batch的下标列表时一次取出整个batch；排序后按文件顺序读取
+        if isinstance(index, list):
+            index = sorted(index)
+        return read_rows(self.x, index), read_rows(self.y, index)
@@ -0,0 +1,175 @@
+import argparse
+import sys
+import time
+import warnings
+
+import torch
+
+import graph
+import save_format
+
+# 不读取数据的形状检查：数据节点按声明的 schema 生成 meta tensor（只有形状，没有数据），
+# preprocess、model、loss 节点在 meta tensor 上执行一次，出错的节点记录为问题
+# 数据节点的 schema 见 epics_get.declare_schema；没有声明的节点和其下游不检查
+# 行数未知的数据（流式数据）用 placeholder_rows 行代替，不检查 x 与 y 的行数是否一致
+# python validate.py example/save.json
+
+PLACEHOLDER_ROWS = 32
+
+
+class ValidationError(Exception):
+    # DL 检查出错误时抛出，problems 随运行的 error 事件发回编辑器，用于标出有问题的节点
+    def __init__(self, problems):
+        super().__init__('Validation failed:\n' + format_problems(problems))
+        self.problems = problems
+
+
+class Validator:
+    def __init__(self):
+        self.values = {}  # node key -> meta tensor，None 表示无法检查
+        self.unknown_rows = set()  # 行数未知的节点
+        self.problems = []
+
+    def problem(self, node, message, level='error'):
+        self.problems.append({'id': node.get('id'), 'name': node['name'], 'level': level, 'message': message})
+
+    def shapes(self) -> dict:
+        return {key: list(value.shape) for key, value in self.values.items() if isinstance(value, torch.Tensor)}
+
+    def evaluate(self, node):
+        import model
+
+        # 按拓扑顺序逐个检查还没有结果的上游节点，不递归
+        follow = lambda node_: model.node_key(node_) not in self.values
+        for node_ in graph.upstream_order([node], model.node_key, follow):
+            key = model.node_key(node_)
+            if key in self.values:
+                continue
+            inputs = [self.values[model.node_key(in_item)] for in_item in node_['in_items']]
+            if any(value is None for value in inputs):
+                # 上游已经有问题
+                self.values[key] = None
+            else:
+                if any(model.node_key(in_item) in self.unknown_rows for in_item in node_['in_items']):
+                    self.unknown_rows.add(key)
+                self.values[key] = self.compute(node_, inputs)
+        return self.values[model.node_key(node)]
+
+    def compute(self, node, inputs):
+        import model
+
+        kwargs = dict(node['kwargs'])
+        try:
+            f = model.resolve(kwargs.pop('func'))
+        except Exception as e:
+            self.problem(node, str(e))
+            return None
+
+        if node['dtype'] == 'data':
+            declare = getattr(f, 'schema', None)
+            if declare is None:
+                self.problem(node, 'No declared schema, shape is not checked.', 'warning')
+                return None
+            try:
+                shape, dtype = declare(**kwargs)
+            except Exception as e:
+                self.problem(node, f'{type(e).__name__}: {e}')
+                return None
+            if shape[0] is None:
+                self.unknown_rows.add(model.node_key(node))
+                shape = (PLACEHOLDER_ROWS,) + tuple(shape[1:])
+            return torch.empty(shape, dtype=dtype, device='meta')
+
+        shapes = ', '.join(str(list(value.shape)) for value in inputs)
+        if node['dtype'] == 'model':
+            try:
+                with torch.device('meta'):
+                    module = f(**kwargs)
+            except Exception as e:
+                self.problem(node, f'{type(e).__name__}: {e}')
+                return None
+            try:
+                return module(*inputs)
+            except NotImplementedError:
+                self.problem(node, 'Not supported on meta tensors, shape is not checked.', 'warning')
+                return None
+            except Exception as e:
+                self.problem(node, f'{type(e).__name__}: {e} (input shapes: {shapes})')
+                return None
+
+        if node['dtype'] == 'preprocess':
+            try:
+                return f(in_items=inputs, **kwargs)
+            except NotImplementedError:
+                self.problem(node, 'Not supported on meta tensors, shape is not checked.', 'warning')
+                return None
+            except Exception as e:
+                self.problem(node, f'{type(e).__name__}: {e} (input shapes: {shapes})')
+                return None
+
+        if node['dtype'] == 'loss':
+            if len(inputs) != 2:
+                self.problem(node, 'Loss needs 2 in_items.')
+                return None
+            known = not any(model.node_key(in_item) in self.unknown_rows for in_item in node['in_items'])
+            if known and inputs[0].size(0) != inputs[1].size(0):
+                self.problem(node, f'Input rows do not match: {shapes}')
+                return None
+            # 按 DL 的顺序确定预测值和目标值
+            y_pred, y_true = inputs if model.in_net(node['in_items'][0]) else inputs[::-1]
+            try:
+                with warnings.catch_warnings(record=True) as caught:
+                    warnings.simplefilter('always')
+                    value = f(**kwargs)(y_pred, y_true)
+            except Exception as e:
+                self.problem(node, f'{type(e).__name__}: {e} (input shapes: {shapes})')
+                return None
+            # 如 MSELoss 对形状不同的输入只给出广播的警告
+            for warning in caught:
+                self.problem(node, f'{warning.message} (input shapes: {shapes})')
+            return value
+
+        return None
+
+
+def validate(models):
+    # models: 嵌套形式的计算图（队尾节点列表）
+    # 返回 (problems, shapes)：problems 为 {id, name, level, message} 列表，level 为 error 或 warning
+    validator = Validator()
+    optimizers = [node for node in models if node['dtype'] == 'optimizer']
+    if not optimizers:
+        validator.problems.append({'id': None, 'name': '', 'level': 'error', 'message': 'No optimizer model.'})
+
+    for optimizer in optimizers:
+        if len(optimizer['in_items']) != 1 or optimizer['in_items'][0]['dtype'] != 'loss':
+            validator.problem(optimizer, 'Wrong in_items of optimizer.')
+            continue
+        validator.evaluate(optimizer['in_items'][0])
+    return validator.problems, validator.shapes()
+
+
+def errors(problems) -> list:
+    return [problem for problem in problems if problem['level'] == 'error']
+
+
+def format_problems(problems) -> str:
+    return '\n'.join(f"{problem['level']}: {problem['name']} (id {problem['id']}): {problem['message']}"
+                     for problem in problems)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the shapes of a saved AIECS experiment without loading data.')
+    parser.add_argument('save_file', help='experiment json saved by the editor')
+    args = parser.parse_args()
+    import model  # 导入时间不计入检查时间
+
+    tic = time.perf_counter()
+    js = save_format.load(args.save_file)
+    problems, shapes = validate(save_format.nest(js))
+    names = {node['id']: node['name'] for node in js['nodes']}
+    for key, shape in shapes.items():
+        print(f'{names.get(key, key)} (id {key}): {shape}')
+    if problems:
+        print(format_problems(problems))
+    print(f'Validated in {(time.perf_counter() - tic) * 1e3:.1f} ms')
+    sys.exit(1 if errors(problems) else 0)